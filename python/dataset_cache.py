@@ -0,0 +1,197 @@
+""" Rasterized training data compiled once into memory-mappable .npy shards
+
+The rasters of a .bin file are the same every epoch, so rendering them every
+epoch only burns CPU. `compile_dataset` runs a RasterPool over the files once
+and writes its batches, in the order the pool delivers them, into shards of
+SHARD_SIZE images:
+
+    <cache root>/<key>/shard_00000.images.npy   [n, side, side] uint8
+    <cache root>/<key>/shard_00000.labels.npy   [n] int64
+    <cache root>/<key>/manifest.json
+
+With packed=True every raster is thresholded to one bit per pixel and
+stored as side * side / 8 bytes with np.packbits, row-major and most
+significant bit first like the grids Grid.tsx sends the server, which
+makes the cache 8 times smaller. The training pipeline unpacks them to the
+same 0/255 pixels the server feeds the model.
+
+The key hashes everything the rasters depend on: the rasterizer backend and
+parameters, the storage format, the drawing filters, the per-file limit and
+the name, size and modification time of every .bin file, so changing any of
+them compiles a new cache next to the old one. A cache only gets its final
+name once every shard and the manifest are written. `CachedDataset` memory-maps the shards
+and hands out batches at disk speed.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from raster_pool import CHUNK_SIZE, RasterPool
+
+CACHE_DIR = "./dataset_cache"
+# Images per shard, 256 MiB of 64x64 rasters
+SHARD_SIZE = 65_536
+MANIFEST = "manifest.json"
+# Bump when the shard layout changes
+FORMAT_VERSION = 1
+# Antialiased pixels at or above this are on in packed shards
+PIXEL_THRESHOLD = 128
+
+
+# pylint: disable-next=too-many-arguments
+def describe_dataset(bin_files, labels, drawing_filters, raster_options, limit_per_file, packed) -> dict:
+    """ Everything the compiled rasters depend on, as JSON-serializable values"""
+    files = []
+    for bin_file, label in zip(bin_files, labels):
+        status = os.stat(bin_file)
+        files.append([os.path.basename(bin_file), int(label), status.st_size, status.st_mtime_ns])
+    return {
+        'format': FORMAT_VERSION,
+        'raster_options': dict(raster_options),
+        'packed': packed,
+        'filters': [name for name, _ in drawing_filters.predicates],
+        'limit_per_file': limit_per_file,
+        'files': files,
+    }
+
+
+def cache_key(description) -> str:
+    """ Directory name of a compiled dataset, readable raster parameters and a hash of the rest"""
+    digest = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+    options = description['raster_options']
+    return (f"{options.get('backend', 'cairo')}_side{options.get('side', 64)}_line{options.get('line_diameter', 12)}"
+            f"_pad{options.get('padding', 26)}{'_packed' if description['packed'] else ''}_{digest}")
+
+
+def _shard_names(number):
+    return f"shard_{number:05d}.images.npy", f"shard_{number:05d}.labels.npy"
+
+
+def pack_rasters(rasters) -> np.ndarray:
+    """ [N, side, side] uint8 rasters as [N, side * side / 8] bytes of one bit per pixel"""
+    return np.packbits(rasters >= PIXEL_THRESHOLD, axis=-1).reshape(len(rasters), -1)
+
+
+# pylint: disable-next=too-many-arguments, too-many-locals
+def compile_dataset(bin_files, labels, drawing_filters, cache_root=CACHE_DIR, raster_options=None,
+                    limit_per_file=None, num_workers=None, shard_size=SHARD_SIZE, packed=False) -> str:
+    """ Directory of the compiled dataset of bin_files, rasterized first if it is not cached yet"""
+    raster_options = dict(raster_options or {})
+    description = describe_dataset(bin_files, labels, drawing_filters, raster_options, limit_per_file, packed)
+    path = os.path.join(cache_root, cache_key(description))
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return path
+
+    # Left over by an interrupted compile, start it again
+    partial = path + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    pool = RasterPool(bin_files, labels, drawing_filters, num_workers=num_workers,
+                      limit_per_file=limit_per_file, raster_options=raster_options)
+    image_shape = (pool.side * pool.side // 8, ) if packed else (pool.side, pool.side)
+    images = np.empty((shard_size, ) + image_shape, dtype=np.uint8)
+    image_labels = np.empty(shard_size, dtype=np.int64)
+    shards = []
+    filled = 0
+
+    def write_shard():
+        images_name, labels_name = _shard_names(len(shards))
+        np.save(os.path.join(partial, images_name), images[:filled])
+        np.save(os.path.join(partial, labels_name), image_labels[:filled])
+        shards.append({'images': images_name, 'labels': labels_name, 'count': filled})
+
+    start = time.perf_counter()
+    try:
+        for rasters, batch_labels in pool.batches():
+            if packed:
+                rasters = pack_rasters(rasters)
+            copied = 0
+            while copied < len(rasters):
+                count = min(len(rasters) - copied, shard_size - filled)
+                images[filled:filled + count] = rasters[copied:copied + count]
+                image_labels[filled:filled + count] = batch_labels[copied:copied + count]
+                filled += count
+                copied += count
+                if filled == shard_size:
+                    write_shard()
+                    filled = 0
+        if filled:
+            write_shard()
+    finally:
+        pool.close()
+
+    manifest = dict(description, shards=shards, images=sum(shard['count'] for shard in shards),
+                    side=pool.side, filter_stats=drawing_filters.stats(),
+                    compile_seconds=time.perf_counter() - start)
+    with open(os.path.join(partial, MANIFEST), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(partial, path)
+    return path
+
+
+class CachedDataset:
+    """ The memory-mapped shards of a compiled dataset.
+
+    Batches of a packed dataset hold the packed bytes, the input pipeline
+    unpacks them with train_on_images.unpack_rasters.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding='utf-8') as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.side = self.manifest['side']
+        self.packed = self.manifest['packed']
+        self.images = [np.load(os.path.join(path, shard['images']), mmap_mode='r')
+                       for shard in self.manifest['shards']]
+        self.labels = [np.load(os.path.join(path, shard['labels']), mmap_mode='r')
+                       for shard in self.manifest['shards']]
+
+    def __len__(self):
+        return self.manifest['images']
+
+    def batches(self, batch_size=CHUNK_SIZE):
+        """ (rasters, labels) of up to batch_size images, in the order they were compiled"""
+        for images, labels in zip(self.images, self.labels):
+            for start in range(0, len(images), batch_size):
+                yield (np.asarray(images[start:start + batch_size]),
+                       np.asarray(labels[start:start + batch_size]))
+
+
+if __name__ == "__main__":
+    # pylint: disable-next=import-outside-toplevel
+    from train_on_images import (BIN_DIR_FILE_LOC, DATASET_CACHE_DIR, PACK_RASTERS, RASTER_OPTIONS, RASTER_WORKERS,
+                                 TRAINING_EXAMPLE_SIZE, TRAINING_FILTERS, VALIDATION_EXAMPLE_SIZE,
+                                 VALIDATION_FILTERS, extract_label_from_filename, list_bin_files,
+                                 load_label_mapping)
+
+    parser = argparse.ArgumentParser(description="Compile the training and validation data into rasterized shards")
+    parser.add_argument("--bin-dir", default=BIN_DIR_FILE_LOC)
+    parser.add_argument("--cache-dir", default=DATASET_CACHE_DIR or CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=RASTER_WORKERS)
+    parser.add_argument("--packed", action="store_true", default=PACK_RASTERS,
+                        help="Store one bit per pixel")
+    args = parser.parse_args()
+
+    files = list_bin_files(args.bin_dir)
+    load_label_mapping(files)
+    for split_filters, split_limit in ((TRAINING_FILTERS, TRAINING_EXAMPLE_SIZE),
+                                       (VALIDATION_FILTERS, VALIDATION_EXAMPLE_SIZE)):
+        cache_path = compile_dataset(files, [extract_label_from_filename(file) for file in files], split_filters,
+                                     args.cache_dir, RASTER_OPTIONS, split_limit, args.workers,
+                                     packed=args.packed)
+
+        dataset = CachedDataset(cache_path)
+        read_start = time.perf_counter()
+        read = sum(len(rasters) for rasters, _ in dataset.batches())
+        read_seconds = time.perf_counter() - read_start
+        size = sum(images.nbytes for images in dataset.images)
+        print(f"{cache_path}: {len(dataset)} images, {size / 2 ** 20:.0f} MiB in {len(dataset.images)} shards, "
+              f"compiled in {dataset.manifest['compile_seconds']:.1f}s, "
+              f"read back at {read / read_seconds:.0f} images/s")
@@ -0,0 +1,135 @@
+""" Header-level filters that run before any drawing is rasterized
+
+Rendering is the expensive step of the data pipeline, so drawings are
+selected on their header fields first. Each predicate takes the
+bin_parser.Drawings columns of a whole file and returns a boolean mask, and
+`DrawingFilters` counts how many drawings every predicate rejected, which
+is the number of rasterizations it saved.
+
+`key_id_split` puts every drawing in the training or the validation split
+on a hash of its key_id alone, so the split is the same on every run and
+for any file order, sharding or number of workers, and each split can be
+read on its own.
+"""
+import threading
+
+import numpy as np
+
+SPLITS = ('train', 'validation')
+# Resolution of the validation fraction of key_id_split
+SPLIT_BUCKETS = 10_000
+
+
+def hash_key_ids(key_ids) -> np.ndarray:
+    """ SplitMix64 finalizer of uint64 key_ids, a fixed, well-mixed hash"""
+    hashed = np.asarray(key_ids, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    hashed = (hashed ^ (hashed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashed = (hashed ^ (hashed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashed ^ (hashed >> np.uint64(31))
+
+
+def recognized():
+    """ Drawings the game recognized"""
+    return 'recognized', lambda drawings: drawings.recognized != 0
+
+
+def country(*codes):
+    """ Drawings from any of the two-letter country codes"""
+    encoded = np.array([code.encode() for code in codes], dtype='S2')
+    return f"country {','.join(codes)}", lambda drawings: np.isin(drawings.country_code, encoded)
+
+
+def timestamp_range(start=None, end=None):
+    """ Drawings with start <= timestamp < end, either bound optional"""
+    def predicate(drawings):
+        mask = np.ones(len(drawings), dtype=bool)
+        if start is not None:
+            mask &= drawings.timestamp >= start
+        if end is not None:
+            mask &= drawings.timestamp < end
+        return mask
+    return f"timestamp [{start}, {end})", predicate
+
+
+def stroke_count(minimum=1, maximum=None):
+    """ Drawings with minimum to maximum strokes"""
+    def predicate(drawings):
+        n_strokes = drawings.n_strokes
+        mask = n_strokes >= minimum
+        if maximum is not None:
+            mask &= n_strokes <= maximum
+        return mask
+    return f"strokes [{minimum}, {maximum}]", predicate
+
+
+def point_count(minimum=1, maximum=None):
+    """ Drawings with minimum to maximum points over all strokes"""
+    def predicate(drawings):
+        n_points = drawings.n_points
+        mask = n_points >= minimum
+        if maximum is not None:
+            mask &= n_points <= maximum
+        return mask
+    return f"points [{minimum}, {maximum}]", predicate
+
+
+def key_id_split(validation_percent, split):
+    """ Drawings of one of SPLITS, validation_percent of all key_ids going to 'validation'"""
+    if split not in SPLITS:
+        raise ValueError(f"Unknown split {split!r}, expected one of {SPLITS}")
+    threshold = np.uint64(round(validation_percent * SPLIT_BUCKETS))
+
+    def predicate(drawings):
+        in_validation = hash_key_ids(drawings.key_id) % np.uint64(SPLIT_BUCKETS) < threshold
+        return in_validation if split == 'validation' else ~in_validation
+    return f"{split} split {validation_percent:g} of key_id", predicate
+
+
+class DrawingFilters:
+    """ Predicates applied in order, with counts of the drawings each one rejected.
+
+    A drawing is counted against the first predicate that rejects it. Safe
+    to share between the interleaved readers of a tf.data pipeline.
+    """
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+        self._lock = threading.Lock()
+        self.seen = 0
+        self.passed = 0
+        self.rejected = {name: 0 for name, _ in predicates}
+
+    def select(self, drawings) -> np.ndarray:
+        """ Numbers of the drawings passing every predicate"""
+        mask = np.ones(len(drawings), dtype=bool)
+        rejected = {}
+        for name, predicate in self.predicates:
+            before = np.count_nonzero(mask)
+            mask &= predicate(drawings)
+            rejected[name] = int(before - np.count_nonzero(mask))
+
+        selected = np.flatnonzero(mask)
+        with self._lock:
+            self.seen += len(drawings)
+            self.passed += len(selected)
+            for name, count in rejected.items():
+                self.rejected[name] += count
+        return selected
+
+    def merge(self, stats):
+        """ Add the counts of stats() from another copy of these filters, e.g. in a worker process"""
+        with self._lock:
+            self.seen += stats['seen']
+            self.passed += stats['passed']
+            for name, count in stats['rejected'].items():
+                self.rejected[name] += count
+
+    def stats(self) -> dict:
+        """ Drawings seen, passed and rejected by each predicate"""
+        with self._lock:
+            return {
+                'seen': self.seen,
+                'passed': self.passed,
+                'rejected': dict(self.rejected),
+                'rasterizations_saved': self.seen - self.passed,
+            }
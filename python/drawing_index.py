@@ -0,0 +1,120 @@
+""" Random access into QuickDraw .bin files through a sidecar offset index
+
+Records in a .bin file have variable length, so finding drawing i means
+walking every record before it. `build_index` walks a file once and saves
+where every record starts next to it, as <file>.bin.idx.npy. `DrawingReader`
+memory-maps the .bin file and that index to hand out any drawing, or any
+contiguous range of drawings, as views into the mapped file.
+"""
+import os
+
+import numpy as np
+
+from bin_parser import HEADER, STROKE_HEADER_SIZE, UINT16, parse_bin_bytes, scan_offsets
+
+INDEX_SUFFIX = '.idx.npy'
+INDEX_ENTRY = np.dtype([('offset', '<u8'), ('length', '<u4'),
+                        ('n_strokes', '<u2'), ('recognized', 'i1')])
+
+
+def index_path(bin_file) -> str:
+    """ Sidecar index file of a .bin file"""
+    return os.fsdecode(bin_file) + INDEX_SUFFIX
+
+
+def _map_file(bin_file):
+    """ Read-only uint8 map of a file, an empty array for an empty file"""
+    if not os.path.getsize(bin_file):
+        return np.zeros(0, dtype=np.uint8)
+    # A plain ndarray over the map, slicing np.memmap itself is several times slower
+    return np.asarray(np.memmap(bin_file, dtype=np.uint8, mode='r'))
+
+
+def build_index(bin_file) -> np.ndarray:
+    """ Walk a .bin file once and save the offset, length, stroke count and recognized flag of every drawing"""
+    data = _map_file(bin_file)
+    header_offsets, _, end = scan_offsets(data)
+
+    index = np.zeros(len(header_offsets), dtype=INDEX_ENTRY)
+    index['offset'] = header_offsets
+    index['length'] = np.diff(np.append(header_offsets, end))
+    headers = data[header_offsets[:, None] + np.arange(HEADER.itemsize)].view(HEADER)[:, 0]
+    index['n_strokes'] = headers['n_strokes']
+    index['recognized'] = headers['recognized']
+
+    # Renamed into place once complete, an interrupted build must not leave an index newer than the file
+    path = index_path(bin_file)
+    partial = f"{path}.{os.getpid()}.partial"
+    with open(partial, 'wb') as index_file:
+        np.save(index_file, index)
+    os.replace(partial, path)
+    return index
+
+
+def load_index(bin_file) -> np.ndarray:
+    """ The index of a .bin file, built first if it is missing or older than the file"""
+    path = index_path(bin_file)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(bin_file):
+        build_index(bin_file)
+    return np.load(path, mmap_mode='r')
+
+
+class DrawingReader:
+    """ Memory-mapped .bin file with random access by drawing number"""
+
+    def __init__(self, bin_file):
+        self.bin_file = bin_file
+        self.index = load_index(bin_file)
+        self.data = _map_file(bin_file)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _span(self, number):
+        entry = self.index[number]
+        return int(entry['offset']), int(entry['offset']) + int(entry['length'])
+
+    def record(self, number) -> np.ndarray:
+        """ Raw bytes of one drawing, a view into the mapped file"""
+        start, end = self._span(number)
+        return self.data[start:end]
+
+    def strokes(self, number):
+        """ [(x, y), ...] of one drawing, views into the mapped file"""
+        start, end = self._span(number)
+        position = start + HEADER.itemsize
+        strokes = []
+        while position < end:
+            n_points, = UINT16.unpack_from(self.data, position)
+            x_start = position + STROKE_HEADER_SIZE
+            strokes.append((self.data[x_start:x_start + n_points],
+                            self.data[x_start + n_points:x_start + 2 * n_points]))
+            position = x_start + 2 * n_points
+        return strokes
+
+    def drawing(self, number) -> dict:
+        """ One drawing in the dictionary form of unpack_drawing"""
+        start, _ = self._span(number)
+        header = self.data[start:start + HEADER.itemsize].view(HEADER)[0]
+        return {
+            'key_id': int(header['key_id']),
+            'country_code': bytes(header['country_code']),
+            'recognized': int(header['recognized']),
+            'timestamp': int(header['timestamp']),
+            'image': self.strokes(number),
+        }
+
+    def drawings(self, start, stop):
+        """ Drawings start to stop as bin_parser.Drawings columns"""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return parse_bin_bytes(b'')
+        return parse_bin_bytes(self.data[self._span(start)[0]:self._span(stop - 1)[1]])
+
+
+if __name__ == "__main__":
+    # pylint: disable-next=import-outside-toplevel
+    from train_on_images import BIN_DIR_FILE_LOC, list_bin_files
+
+    for filename in list_bin_files(BIN_DIR_FILE_LOC):
+        print(f"{filename}: {len(build_index(filename))} drawings")
@@ -0,0 +1,161 @@
+""" Post-training quantization of the trained model with an accuracy, size and latency report"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from inception_module import InceptionModule
+from train_on_images import (NUM_CLASSES, create_validation_dataset,
+                             list_bin_files, load_label_mapping, unpack_drawings)
+
+REPRESENTATIVE_SIZE = 1_000
+EVALUATION_SIZE = 10_000
+LATENCY_RUNS = 200
+
+VARIANTS = ('float32', 'dynamic', 'float16', 'int8')
+
+
+def representative_dataset(bin_files, num_samples=REPRESENTATIVE_SIZE):
+    """ Calibration samples for full int8, taken round robin over every class file"""
+    per_file = max(1, num_samples // len(bin_files))
+    generators = [itertools.islice(unpack_drawings(filename), per_file)
+                  for filename in bin_files]
+
+    def generator():
+        for img_data, _ in itertools.islice(
+                itertools.chain.from_iterable(zip(*generators)), num_samples):
+            yield [np.reshape(img_data, (1, 64, 64, 1)).astype(np.float32)]
+
+    return generator
+
+
+def convert(model, variant, bin_files=None):
+    """ Returns the TFLite flatbuffer of model for one quantization variant"""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if variant == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif variant == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(bin_files)
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    elif variant != 'float32':
+        raise ValueError(f"Unknown quantization variant {variant!r}")
+
+    return converter.convert()
+
+
+class TFLiteClassifier:
+    """ Runs a TFLite model on float 0-255 images, handling int8 input/output quantization"""
+
+    def __init__(self, model_content, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(
+            model_content=model_content, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def __call__(self, images):
+        if len(images) != self.batch_size:
+            self.interpreter.resize_tensor_input(
+                self.input['index'], (len(images), 64, 64, 1))
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(images)
+
+        if self.input['dtype'] != np.float32:
+            scale, zero_point = self.input['quantization']
+            info = np.iinfo(self.input['dtype'])
+            images = np.clip(np.round(images / scale + zero_point),
+                             info.min, info.max).astype(self.input['dtype'])
+
+        self.interpreter.set_tensor(self.input['index'], images)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output['index'])
+
+        if self.output['dtype'] != np.float32:
+            scale, zero_point = self.output['quantization']
+            output = scale * (output.astype(np.float32) - zero_point)
+        return output
+
+
+def evaluate(classifier, validation_dataset):
+    """ Top-1 and top-3 accuracy over a batched (images, labels) dataset"""
+    top1 = top3 = total = 0
+    for images, labels in validation_dataset.as_numpy_iterator():
+        images = np.reshape(images, (-1, 64, 64, 1)).astype(np.float32)
+        output = classifier(images)
+        best3 = np.argpartition(output, -3, axis=1)[:, -3:]
+        top1 += np.sum(np.argmax(output, axis=1) == labels)
+        top3 += np.sum(np.any(best3 == labels[:, None], axis=1))
+        total += len(labels)
+    return float(top1 / total), float(top3 / total)
+
+
+def single_image_latency(classifier, runs=LATENCY_RUNS):
+    """ p50/p99 latency in milliseconds of one 64x64 image"""
+    image = 255 * np.random.randint(0, 2, (1, 64, 64, 1)).astype(np.float32)
+    classifier(image)
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        classifier(image)
+        latencies.append(1000. * (time.perf_counter() - start))
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--model', default='inception_done.keras')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--evaluation-size', type=int, default=EVALUATION_SIZE)
+    parser.add_argument('--num-threads', type=int, default=1)
+    args = parser.parse_args()
+
+    bin_files = list_bin_files()
+    load_label_mapping(bin_files)
+
+    # Same held-out split the training script validates on. Built first, the
+    # raster workers must fork before loading the model starts TensorFlow's threads
+    validation_dataset = create_validation_dataset(bin_files, NUM_CLASSES)
+    validation_dataset = validation_dataset.unbatch().take(
+        args.evaluation_size).batch(256).cache()
+
+    keras_model = tf.keras.models.load_model(
+        args.model, custom_objects={"InceptionModule": InceptionModule})
+
+    report = {}
+    for variant in VARIANTS:
+        tflite_model = convert(keras_model, variant, bin_files)
+        path = os.path.join(args.output_dir, f"model_{variant}.tflite")
+        with open(path, 'wb') as f:
+            f.write(tflite_model)
+
+        classifier = TFLiteClassifier(
+            tflite_model, num_threads=args.num_threads)
+        top1, top3 = evaluate(classifier, validation_dataset)
+        p50, p99 = single_image_latency(classifier)
+        report[variant] = {
+            'path': path,
+            'size_bytes': len(tflite_model),
+            'top1': top1,
+            'top3': top3,
+            'latency_p50_ms': p50,
+            'latency_p99_ms': p99,
+        }
+
+    print(f"{'variant':>8} {'size MB':>8} {'top-1':>7} {'top-3':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for variant, row in report.items():
+        print(f"{variant:>8} {row['size_bytes'] / 2**20:>8.2f} {row['top1']:>7.4f} {row['top3']:>7.4f} "
+              f"{row['latency_p50_ms']:>8.2f} {row['latency_p99_ms']:>8.2f}")
+
+    with open(os.path.join(args.output_dir, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
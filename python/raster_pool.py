@@ -0,0 +1,255 @@
+""" Multi-process parsing and rasterization feeding the tf.data pipeline
+
+Parsing and Cairo rendering are pure Python and hold the GIL, so
+interleaving from_generator readers in tf.data runs them one at a time.
+RasterPool forks worker processes that each open the .bin files through
+their drawing index, filter and rasterize chunks of drawings, and write the
+rasters into shared-memory slots. The parent only hands the finished
+(N, 64, 64) uint8 batches to TensorFlow.
+
+Chunks are handed out round robin over the files and their batches come
+back in that same order, so every pass over the pool yields the same
+sequence whatever the number of workers. A worker that dies, e.g. killed
+for running out of memory, fails the pass and closes the pool instead of
+leaving it waiting for a batch that never comes.
+"""
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from drawing_filters import DrawingFilters
+from drawing_index import DrawingReader, load_index
+from rasterizer import make_rasterizer
+
+# Drawings read per task, also the capacity of a slot
+CHUNK_SIZE = 256
+SIDE = 64
+# Seconds between liveness checks of the workers while waiting for a batch
+WATCH_INTERVAL = 1.
+
+
+def _slot_view(memory, num_slots, chunk_size, side):
+    """ [slot, raster, row, column] uint8 array over shared memory"""
+    return np.ndarray((num_slots, chunk_size, side, side), dtype=np.uint8, buffer=memory.buf)
+
+
+# pylint: disable-next=too-many-arguments
+def _worker_main(memory_name, num_slots, chunk_size, raster_options, bin_files, drawing_filters,
+                 tasks, results):
+    """ Worker process: serve (slot, file number, start, stop) tasks until a None arrives"""
+    rasterizer = make_rasterizer(**raster_options)
+    memory = shared_memory.SharedMemory(name=memory_name)
+    rasters = _slot_view(memory, num_slots, chunk_size, rasterizer.side)
+    readers = {}
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, file_number, start, stop = task
+        try:
+            if file_number not in readers:
+                readers[file_number] = DrawingReader(bin_files[file_number])
+            drawings = readers[file_number].drawings(start, stop)
+            # Fresh counters per task, the parent adds them up
+            task_filters = DrawingFilters(*drawing_filters.predicates)
+            selected = task_filters.select(drawings)
+            rasterizer.rasterize_drawings(drawings, selected, rasters[slot, :len(selected)])
+            results.put(("done", slot, (len(selected), task_filters.stats())))
+        # pylint: disable-next=broad-except
+        except Exception:
+            results.put(("error", slot, traceback.format_exc()))
+
+    del rasters
+    memory.close()
+
+
+class RasterPool:
+    """ Worker processes rasterizing the drawings of a set of .bin files.
+
+    `batches` yields (rasters, labels) with up to chunk_size [side, side]
+    uint8 rasters of one file and their labels, at most limit_per_file per
+    file. raster_options are the make_rasterizer parameters.
+    One pass at a time: concurrent passes wait for each other.
+
+    Workers are forked, so create the pool before TensorFlow starts its
+    thread pools, i.e. before building any dataset or model.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, bin_files, labels, drawing_filters, num_workers=None,
+                 limit_per_file=None, chunk_size=CHUNK_SIZE, num_slots=None, raster_options=None):
+        context = multiprocessing.get_context("fork")
+        self.bin_files = list(bin_files)
+        self.labels = list(labels)
+        self.drawing_filters = drawing_filters
+        self.num_workers = num_workers or os.cpu_count()
+        self.limit_per_file = limit_per_file
+        self.chunk_size = chunk_size
+        self.raster_options = dict(raster_options or {})
+        self.side = self.raster_options.get('side', SIDE)
+        num_slots = num_slots or 4 * self.num_workers
+
+        # Builds any missing index here rather than once per worker
+        self.file_sizes = [len(load_index(bin_file)) for bin_file in self.bin_files]
+
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=num_slots * chunk_size * self.side * self.side)
+        self._rasters = _slot_view(self._memory, num_slots, chunk_size, self.side)
+        self._num_slots = num_slots
+        self._pass_lock = threading.Lock()
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+
+        self._processes = [
+            context.Process(
+                target=_worker_main, name=f"raster-worker-{worker_id}", daemon=True,
+                args=(self._memory.name, num_slots, chunk_size, self.raster_options,
+                      self.bin_files, drawing_filters, self._tasks, self._results))
+            for worker_id in range(self.num_workers)
+        ]
+        for process in self._processes:
+            process.start()
+        atexit.register(self.close)
+
+    def _chunks(self):
+        """ (file number, start, stop) round robin over the files"""
+        for start in range(0, max(self.file_sizes, default=0), self.chunk_size):
+            for file_number, size in enumerate(self.file_sizes):
+                if start < size:
+                    yield file_number, start, min(start + self.chunk_size, size)
+
+    def batches(self):
+        """ (rasters, labels) of every file, in the same order on every pass"""
+        with self._pass_lock:
+            if self._memory is None:
+                raise RuntimeError("The raster pool is closed")
+            yield from self._run_pass()
+
+    def _next_result(self):
+        """ Next worker message, closing the pool and raising if a worker died"""
+        while True:
+            try:
+                return self._results.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                dead = [process for process in self._processes if not process.is_alive()]
+                if dead:
+                    # Its task never finishes, so no pass can complete any more
+                    self.close()
+                    raise RuntimeError(
+                        f"Raster worker {dead[0].name} exited with code {dead[0].exitcode}") from None
+
+    def _run_pass(self):
+        limit = self.limit_per_file
+        delivered = [0] * len(self.bin_files)
+        chunks = self._chunks()
+        free_slots = list(range(self._num_slots))
+        in_flight = {}
+        finished = {}
+        next_to_submit = next_to_deliver = 0
+
+        def submit():
+            nonlocal next_to_submit
+            while free_slots:
+                for file_number, start, stop in chunks:
+                    # Files already full in delivery order produce nothing more
+                    if limit is None or delivered[file_number] < limit:
+                        break
+                else:
+                    return
+                slot = free_slots.pop()
+                in_flight[slot] = (next_to_submit, file_number)
+                next_to_submit += 1
+                self._tasks.put((slot, file_number, start, stop))
+
+        try:
+            submit()
+            while in_flight or finished:
+                while next_to_deliver not in finished:
+                    status, slot, payload = self._next_result()
+                    sequence, file_number = in_flight.pop(slot)
+                    if status != "done":
+                        free_slots.append(slot)
+                        raise RuntimeError(f"Rasterizing {self.bin_files[file_number]} failed:\n{payload}")
+                    finished[sequence] = (slot, file_number, payload)
+
+                slot, file_number, (count, filter_stats) = finished.pop(next_to_deliver)
+                next_to_deliver += 1
+                self.drawing_filters.merge(filter_stats)
+                if limit is not None:
+                    count = min(count, limit - delivered[file_number])
+                delivered[file_number] += count
+                # Copied out so the slot goes straight back to the workers
+                rasters = self._rasters[slot, :count].copy()
+                free_slots.append(slot)
+                submit()
+                if count:
+                    yield rasters, np.full(count, self.labels[file_number], dtype=np.int64)
+        finally:
+            # Wait out the tasks still running so the next pass starts clean
+            if self._memory is not None:
+                for _ in range(len(in_flight)):
+                    self._next_result()
+
+    def close(self):
+        """ Stop the workers and free the shared memory"""
+        if self._memory is None:
+            return
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        del self._rasters
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+
+def measure_throughput(bin_files, labels, drawing_filters, num_workers, num_images):
+    """ Rasters per second of a pool with num_workers workers, over the first num_images"""
+    pool = RasterPool(bin_files, labels, drawing_filters, num_workers=num_workers)
+    try:
+        produced = 0
+        start = time.perf_counter()
+        for rasters, _ in pool.batches():
+            produced += len(rasters)
+            if produced >= num_images:
+                break
+        return produced / (time.perf_counter() - start)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    # pylint: disable-next=import-outside-toplevel
+    from train_on_images import (BIN_DIR_FILE_LOC, TRAINING_FILTERS, extract_label_from_filename,
+                                 list_bin_files, load_label_mapping)
+
+    parser = argparse.ArgumentParser(description="Rasterization throughput from 1 worker to every core")
+    parser.add_argument("--bin-dir", default=BIN_DIR_FILE_LOC)
+    parser.add_argument("--images", type=int, default=50_000)
+    args = parser.parse_args()
+
+    files = list_bin_files(args.bin_dir)
+    load_label_mapping(files)
+    file_labels = [extract_label_from_filename(bin_file) for bin_file in files]
+
+    worker_counts = sorted({1, os.cpu_count()} | {2 ** i for i in range(1, 8) if 2 ** i < os.cpu_count()})
+    curve = {}
+    for workers in worker_counts:
+        curve[workers] = measure_throughput(files, file_labels, TRAINING_FILTERS, workers, args.images)
+        print(f"{workers:3d} workers: {curve[workers]:9.0f} images/s "
+              f"({curve[workers] / curve[1]:.2f}x)")
+    print(json.dumps({"images_per_second": curve}, indent=2))
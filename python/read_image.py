@@ -12,45 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
-import struct
-from struct import unpack
 import numpy as np
 from PIL import Image
 import cairocffi as cairo
-
-
-def unpack_drawing(file_handle):
-    """ Helper function of unpack_drawings"""
-    key_id, = unpack('Q', file_handle.read(8))
-    country_code, = unpack('2s', file_handle.read(2))
-    recognized, = unpack('b', file_handle.read(1))
-    timestamp, = unpack('I', file_handle.read(4))
-    n_strokes, = unpack('H', file_handle.read(2))
-    image = []
-    for i in range(n_strokes):
-        n_points, = unpack('H', file_handle.read(2))
-        fmt = str(n_points) + 'B'
-        x = unpack(fmt, file_handle.read(n_points))
-        y = unpack(fmt, file_handle.read(n_points))
-        image.append((x, y))
-
-    return {
-        'key_id': key_id,
-        'country_code': country_code,
-        'recognized': recognized,
-        'timestamp': timestamp,
-        'image': image
-    }
+from bin_parser import parse_bin_file
 
 
 def unpack_drawings(filename):
     """ Takes in .bin file and returns simplified representation of image in a dictionary"""
-    with open(filename, 'rb') as file_handle:
-        while True:
-            try:
-                yield unpack_drawing(file_handle)
-            except struct.error:
-                break
+    yield from parse_bin_file(filename)
 
 #pylint: disable-next=too-many-arguments, too-many-locals, line-too-long
 def vector_to_raster(vector_images, side=28, line_diameter=16, padding=16, bg_color=(0, 0, 0), fg_color=(1, 1, 1)):
@@ -1,7 +1,6 @@
 """ Trains a neraul netword on a set of images located in .bin and save the tensorflow model"""
+import functools
 import os
-import struct
-from struct import unpack
 import traceback
 import logging
 
@@ -13,6 +12,11 @@ import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint
 import matplotlib.pyplot as plt
 from inception_module import InceptionModule
+from drawing_index import DrawingReader
+from drawing_filters import DrawingFilters, key_id_split, recognized
+from rasterizer import make_rasterizer
+from raster_pool import RasterPool
+from dataset_cache import CachedDataset, compile_dataset
 from PIL import Image
 
 
@@ -20,37 +24,43 @@ BIN_DIR_FILE_LOC = "./binary_images"
 NUM_CLASSES = 121
 EPOCHS = 20
 INDIVIDUAL_EXAMPLE_SIZE = 15_000
+# Drawings rendered per rasterizer call in unpack_drawings
+RASTER_BATCH_SIZE = 256
+# Processes parsing and rasterizing for the dataset, 0 to do it in tf.data's own threads
+RASTER_WORKERS = os.cpu_count()
+# Rasterizer backend ('cairo' or 'numpy') and parameters of the training data, part of the dataset cache key
+RASTER_OPTIONS = {'backend': 'cairo', 'side': 64, 'line_diameter': 12, 'padding': 26}
+# Compiled rasters are kept here and reused across runs, None to rasterize every epoch
+DATASET_CACHE_DIR = "./dataset_cache"
+# Cache rasters at one bit per pixel, the 0/255 pixels of the grids the server predicts on
+PACK_RASTERS = False
+# Most significant bit first, the bit order of np.packbits
+BIT_MASKS = np.left_shift(1, np.arange(7, -1, -1)).astype(np.uint8)
 VALIDATION_PERCENT = .1
 BATCH_SIZE = 64
 LABEL_MAPPING = {}
+# Select drawings on their header fields before they are rasterized, the
+# split on a hash of key_id keeps a drawing in the same split on every run
+TRAINING_FILTERS = DrawingFilters(recognized(), key_id_split(VALIDATION_PERCENT, 'train'))
+VALIDATION_FILTERS = DrawingFilters(recognized(), key_id_split(VALIDATION_PERCENT, 'validation'))
 L = logging.getLogger(__name__)
 ## ------ Helper Functions ------- ##
 
-VALIDATION_SIZE = int(VALIDATION_PERCENT*NUM_CLASSES*INDIVIDUAL_EXAMPLE_SIZE)
-
-
-def unpack_drawing(file_handle):
-    """ Helper function of unpack_drawings"""
-    key_id, = unpack('Q', file_handle.read(8))
-    country_code, = unpack('2s', file_handle.read(2))
-    recognized, = unpack('b', file_handle.read(1))
-    timestamp, = unpack('I', file_handle.read(4))
-    n_strokes, = unpack('H', file_handle.read(2))
-    image = []
-    for _ in range(n_strokes):
-        n_points, = unpack('H', file_handle.read(2))
-        fmt = str(n_points) + 'B'
-        x = unpack(fmt, file_handle.read(n_points))
-        y = unpack(fmt, file_handle.read(n_points))
-        image.append((x, y))
-
-    return {
-        'key_id': key_id,
-        'country_code': country_code,
-        'recognized': recognized,
-        'timestamp': timestamp,
-        'image': image
-    }
+# Drawings of each split per class file
+VALIDATION_EXAMPLE_SIZE = int(VALIDATION_PERCENT*INDIVIDUAL_EXAMPLE_SIZE)
+TRAINING_EXAMPLE_SIZE = INDIVIDUAL_EXAMPLE_SIZE - VALIDATION_EXAMPLE_SIZE
+
+
+def list_bin_files(bin_dir=BIN_DIR_FILE_LOC):
+    """ Returns the paths of every .bin file in bin_dir"""
+    return [os.path.join(bin_dir, file) for file in os.listdir(bin_dir) if file.endswith('.bin')]
+
+
+def load_label_mapping(bin_files):
+    """ Fills LABEL_MAPPING with one class number per .bin file and returns it"""
+    LABEL_MAPPING.update(zip([os.path.splitext(
+        os.path.basename(filename))[0] for filename in bin_files], range(NUM_CLASSES)))
+    return LABEL_MAPPING
 
 
 def extract_label_from_filename(filename):
@@ -59,36 +69,32 @@ def extract_label_from_filename(filename):
     return LABEL_MAPPING.get(label, -1)
 
 
-def unpack_drawings(filename):
-    """ Takes in .bin file and returns simplified representation of image in a dictionary"""
+def unpack_drawings(filename, drawing_filters=None, limit=TRAINING_EXAMPLE_SIZE):
+    """ Takes in .bin file and yields (raster, label) of the first limit drawings passing drawing_filters"""
+    if drawing_filters is None:
+        drawing_filters = TRAINING_FILTERS
 
     label = extract_label_from_filename(str(filename))
-    with open(filename, 'rb') as file_handle:
-        num_img = 0
-        while True and (num_img < INDIVIDUAL_EXAMPLE_SIZE):
-            try:
-                drawing = unpack_drawing(file_handle)
-
-                image = drawing['image']
-
-                raster = vector_to_raster([image])
-
-                img_data = np.reshape(raster[0], (64, 64))
-
-                # img = Image.fromarray(img_data, 'L')
-                # img.save(f"{label}.png")
-                if drawing['recognized']:
-                    yield (img_data, label)
-                    num_img += 1
-            except struct.error:
-                break
-            # pylint: disable-next=broad-except
-            except Exception:
-                print("Other Error", traceback.format_exc())
-
-                break
-        # print(f"End of File {filename} with {num_img} uses")
-        return
+    # Parsed a chunk at a time from the mapped file, callers keep one of these open per class
+    reader = DrawingReader(filename)
+    rasterizer = make_rasterizer(**RASTER_OPTIONS)
+    remaining = limit
+    for start in range(0, len(reader), RASTER_BATCH_SIZE):
+        if remaining is not None and remaining <= 0:
+            break
+        drawings = reader.drawings(start, start + RASTER_BATCH_SIZE)
+        # Filter on the cheap header fields first, rasterizing is the expensive step
+        selected = drawing_filters.select(drawings)[:remaining]
+        if remaining is not None:
+            remaining -= len(selected)
+        try:
+            rasters = rasterizer.rasterize_drawings(drawings, selected)
+        # pylint: disable-next=broad-except
+        except Exception:
+            print("Other Error", traceback.format_exc())
+
+            break
+        yield from ((img_data, label) for img_data in rasters)
 
 
 def vector_to_raster(vector_images, side=64, line_diameter=12, padding=26, bg_color=(0, 0, 0), fg_color=(1, 1, 1)):
@@ -138,33 +144,87 @@ def vector_to_raster(vector_images, side=64, line_diameter=12, padding=26, bg_co
     return raster_images
 
 
-def parse_bin_file(filename):
-    """ Returns List of TensorFlow Examples from one .bin image file"""
-    examples = []
-    label = extract_label_from_filename(filename)
-    for drawing in unpack_drawings(filename):
-        # do something with the drawing
-        # print(drawing['image'])
-        image = drawing['image']
+# pylint: disable-next=too-many-arguments
+def create_tf_dataset(files, num_classes, shuffle_buffer_size=100_000, seed=42, batch_size=64,
+                      raster_workers=RASTER_WORKERS, cache_dir=DATASET_CACHE_DIR):
+    """ Create Function Method"""
+    labels = [extract_label_from_filename(file) for file in files]
+    validation_workers = max(1, round(raster_workers * VALIDATION_PERCENT)) if raster_workers else 0
+    # Both splits fork their workers here, before TensorFlow runs anything
+    splits = [(split_batches(files, labels, drawing_filters, limit, workers, cache_dir), drawing_filters, limit)
+              for drawing_filters, limit, workers in (
+                  (TRAINING_FILTERS, TRAINING_EXAMPLE_SIZE, raster_workers),
+                  (VALIDATION_FILTERS, VALIDATION_EXAMPLE_SIZE, validation_workers))]
 
-        raster = vector_to_raster([image])
+    dataset, v_data = [
+        batched_dataset(*batches) if batches else interleaved_dataset(files, num_classes, seed, drawing_filters, limit)
+        for batches, drawing_filters, limit in splits]
 
-        img_data = np.reshape(raster[0], (64, 64))
+    dataset = dataset.shuffle(shuffle_buffer_size, seed=seed)
 
-        # img = Image.fromarray(img_data, 'L')
-        # img.save('my.png')
+    return dataset.batch(batch_size).prefetch(1), v_data.batch(batch_size).cache()
 
-        examples.append((img_data, label))
-    return examples
 
+# pylint: disable-next=too-many-arguments
+def create_validation_dataset(files, num_classes, seed=42, batch_size=64, raster_workers=RASTER_WORKERS,
+                              cache_dir=DATASET_CACHE_DIR):
+    """ The validation split of create_tf_dataset alone, for evaluating a trained model"""
+    labels = [extract_label_from_filename(file) for file in files]
+    batches = split_batches(files, labels, VALIDATION_FILTERS, VALIDATION_EXAMPLE_SIZE, raster_workers, cache_dir)
+    if batches:
+        v_data = batched_dataset(*batches)
+    else:
+        v_data = interleaved_dataset(files, num_classes, seed, VALIDATION_FILTERS, VALIDATION_EXAMPLE_SIZE)
+    return v_data.batch(batch_size).cache()
+
+
+# pylint: disable-next=too-many-arguments
+def split_batches(files, labels, drawing_filters, limit_per_file, raster_workers, cache_dir):
+    """ (generator function of (rasters, labels) batches, packed) of one split, None without workers or cache"""
+    if cache_dir:
+        # Rasterizes in forked workers on the first run
+        cache_path = compile_dataset(files, labels, drawing_filters, cache_dir, RASTER_OPTIONS,
+                                     limit_per_file, raster_workers or 1, packed=PACK_RASTERS)
+        L.info("Reading rasters from %s", cache_path)
+        cached = CachedDataset(cache_path)
+        return cached.batches, cached.packed
+    if raster_workers:
+        pool = RasterPool(files, labels, drawing_filters, num_workers=raster_workers,
+                          limit_per_file=limit_per_file, raster_options=RASTER_OPTIONS)
+        return pool.batches, False
+    return None
+
+
+def unpack_rasters(packed, labels):
+    """ [N, side, side] 0/255 rasters of a batch of packed rasters, one vectorized op per step"""
+    side = RASTER_OPTIONS['side']
+    bits = tf.bitwise.bitwise_and(packed[..., tf.newaxis], BIT_MASKS)
+    rasters = tf.cast(bits > 0, tf.uint8) * 255
+    return tf.reshape(rasters, (-1, side, side)), labels
+
+
+def batched_dataset(batches, packed=False):
+    """ (raster, label) dataset of a generator function of (rasters, labels) batches"""
+    side = RASTER_OPTIONS['side']
+    dataset = tf.data.Dataset.from_generator(
+        batches,
+        output_signature=(
+            tf.TensorSpec(shape=(None, side * side // 8) if packed else (None, side, side), dtype=tf.uint8),
+            tf.TensorSpec(shape=(None, ), dtype=tf.int64)
+        )
+    )
+    if packed:
+        dataset = dataset.map(unpack_rasters, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.unbatch()
 
-def create_tf_dataset(files, num_classes, shuffle_buffer_size=100_000, seed=42, batch_size=64, validation_size=100_000):
-    """ Create Function Method"""
+
+def interleaved_dataset(files, num_classes, seed=42, drawing_filters=None, limit=TRAINING_EXAMPLE_SIZE):
+    """ (raster, label) of every file, with unpack_drawings run by tf.data's interleave"""
     filepath_dataset = tf.data.Dataset.list_files(files, seed=seed)
 
-    dataset = filepath_dataset.interleave(
+    return filepath_dataset.interleave(
         lambda filepath: tf.data.Dataset.from_generator(
-            unpack_drawings, args=(filepath, ),
+            functools.partial(unpack_drawings, drawing_filters=drawing_filters, limit=limit), args=(filepath, ),
             output_signature=(
                 tf.TensorSpec(shape=(64, 64), dtype=tf.uint8),
                 tf.TensorSpec(shape=(), dtype=tf.int64)
@@ -174,26 +234,17 @@ def create_tf_dataset(files, num_classes, shuffle_buffer_size=100_000, seed=42,
         num_parallel_calls=tf.data.AUTOTUNE
     )
 
-    v_data = dataset.take(validation_size)
-
-    dataset = dataset.skip(validation_size).shuffle(
-        shuffle_buffer_size, seed=seed)
-
-    return dataset.batch(batch_size).prefetch(1), v_data.batch(batch_size).cache()
-
 
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
 
-    bin_files = [os.path.join(BIN_DIR_FILE_LOC, file) for file in os.listdir(
-        BIN_DIR_FILE_LOC) if file.endswith('.bin')]
-    LABEL_MAPPING = dict(zip([os.path.splitext(
-        os.path.basename(filename))[0] for filename in bin_files], range(NUM_CLASSES)))
+    bin_files = list_bin_files()
+    load_label_mapping(bin_files)
 
     # Shuffle the dataset - Each bin file contains around 150,000 images with around 35 times
     train_dataset, validation_dataset = create_tf_dataset(
-        bin_files, NUM_CLASSES, shuffle_buffer_size=int(NUM_CLASSES*INDIVIDUAL_EXAMPLE_SIZE) + 1, batch_size=BATCH_SIZE, validation_size=VALIDATION_SIZE)
+        bin_files, NUM_CLASSES, shuffle_buffer_size=int(NUM_CLASSES*INDIVIDUAL_EXAMPLE_SIZE) + 1, batch_size=BATCH_SIZE)
 
     data_augmentation = tf.keras.Sequential(
         [
@@ -247,6 +298,8 @@ if __name__ == "__main__":
         verbose=1,
         callbacks=[checkpoint_callback]
     )
+    L.info("Training filters: %s", TRAINING_FILTERS.stats())
+    L.info("Validation filters: %s", VALIDATION_FILTERS.stats())
 
     acc = HISTORY.history['accuracy']
     val_acc = HISTORY.history['val_accuracy']
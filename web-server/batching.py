@@ -0,0 +1,145 @@
+"""Request coalescing for the ML-Draw prediction server"""
+
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+
+class Overloaded(Exception):
+    """Raised by MicroBatcher.submit when the admission queue is full"""
+
+
+class MicroBatcher:
+    """Collects concurrent predictions into one batched forward pass.
+
+    Requests are queued by `submit` and picked up by `num_workers` background
+    threads. Each waits at most `max_wait_ms` after the first request of a
+    batch for up to `max_batch_size` requests, calls `predict_batch` once with
+    the list of inputs and resolves every waiting future with its own output.
+
+    At most `max_queue_size` requests wait in the queue (0 for no limit), past
+    that `submit` raises Overloaded so callers can shed load. Requests whose
+    future was cancelled while queued are dropped before inference.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5.0,
+                 max_queue_size=0, num_workers=1):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = [0] * (max_batch_size + 1)
+        self._requests = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._wait_total = 0.
+        self._wait_max = 0.
+
+        self._threads = [
+            threading.Thread(target=self._run,
+                             name=f"micro-batcher-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item) -> Future:
+        """Queue one input and return a future resolving to its output"""
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full as error:
+            with self._stats_lock:
+                self._rejected += 1
+            raise Overloaded(
+                f"{self._queue.maxsize} predictions already queued") from error
+        return future
+
+    def predict(self, item):
+        """Blocking helper around submit"""
+        return self.submit(item).result()
+
+    def close(self):
+        """Stop the background threads once the queued requests are served"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        """Queue depth, batch size histogram, queue wait times and shed requests"""
+        with self._stats_lock:
+            requests = self._requests
+            return {
+                "queue_depth": self._queue.qsize(),
+                "requests": requests,
+                "rejected": self._rejected,
+                "cancelled": self._cancelled,
+                "batches": sum(self._batch_sizes),
+                "batch_size_histogram": {
+                    size: count for size, count in enumerate(self._batch_sizes) if count
+                },
+                "mean_wait_ms": 1000. * self._wait_total / requests if requests else 0.,
+                "max_wait_ms": 1000. * self._wait_max,
+            }
+
+    def _collect(self):
+        """Block for the first request, then fill the batch until the window closes"""
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    request = self._queue.get(timeout=remaining)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Serve what we have, then let the run loop see the sentinel
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            started = time.perf_counter()
+            live = [request for request in batch
+                    if request[1].set_running_or_notify_cancel()]
+            with self._stats_lock:
+                self._cancelled += len(batch) - len(live)
+            if not live:
+                continue
+
+            waits = [started - queued_at for _, _, queued_at in live]
+            with self._stats_lock:
+                self._batch_sizes[len(live)] += 1
+                self._requests += len(live)
+                self._wait_total += sum(waits)
+                self._wait_max = max(self._wait_max, max(waits))
+
+            try:
+                outputs = self.predict_batch([item for item, _, _ in live])
+            # pylint: disable-next=broad-except
+            except Exception as error:
+                traceback.print_exc()
+                for _, future, _ in live:
+                    future.set_exception(error)
+                continue
+
+            for (_, future, _), output in zip(live, outputs):
+                future.set_result(output)
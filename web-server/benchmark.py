@@ -0,0 +1,70 @@
+"""Inference latency benchmark for ML-Draw: model.predict vs the compiled forward function"""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow
+from inception_module import InceptionModule
+from inference import CompiledModel, served_batch_sizes
+
+
+def measure(predict, batch, iterations):
+    """ Returns per-call latencies in milliseconds"""
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        predict(batch)
+        latencies[i] = time.perf_counter() - start
+    return 1000. * latencies
+
+
+def summarize(latencies):
+    """ p50/p99/mean of a latency sample"""
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+def compare_inference_paths(model, batch_sizes, iterations=200, jit_compile=False):
+    """ Latency of model.predict against CompiledModel for each batch size"""
+    compiled = CompiledModel(model, batch_sizes=batch_sizes,
+                             jit_compile=jit_compile)
+    compiled.warmup()
+
+    results = {}
+    for size in batch_sizes:
+        batch = 255 * np.random.randint(
+            0, 2, size=(size, 64, 64, 1)).astype(np.float32)
+        # First predict call builds the predict function, keep it out of the sample
+        model.predict(batch, verbose=0)
+        results[size] = {
+            "predict": summarize(measure(
+                lambda x: model.predict(x, verbose=0), batch, iterations)),
+            "compiled": summarize(measure(compiled, batch, iterations)),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="model.h5")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--xla", action="store_true")
+    args = parser.parse_args()
+
+    keras_model = tensorflow.keras.models.load_model(
+        args.model, custom_objects={"InceptionModule": InceptionModule})
+
+    report = compare_inference_paths(
+        keras_model, served_batch_sizes(args.max_batch_size),
+        iterations=args.iterations, jit_compile=args.xla)
+
+    print(f"{'batch':>5} {'path':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for batch_size, paths in report.items():
+        for path, stats in paths.items():
+            print(
+                f"{batch_size:>5} {path:>9} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
@@ -0,0 +1,89 @@
+"""Prediction cache for the ML-Draw prediction server"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """Bounded LRU of model outputs keyed on a hash of the 512-byte packed grid.
+
+    Entries older than ttl_seconds (if given) count as misses. Pinned entries,
+    such as the empty canvas, are never evicted or expired.
+    """
+
+    def __init__(self, max_size=10_000, ttl_seconds=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(grid) -> bytes:
+        """ 128-bit digest of a bytes-like grid"""
+        return hashlib.blake2b(grid, digest_size=16).digest()
+
+    def get(self, grid):
+        """ Cached output for grid, or None"""
+        key = self.key(grid)
+        with self._lock:
+            if key in self._pinned:
+                self.hits += 1
+                return self._pinned[key]
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl_seconds is None or time.monotonic() - stored_at < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, grid, value):
+        """ Store the output for grid, evicting the least recently used entry when full"""
+        if self.max_size <= 0:
+            return
+        key = self.key(grid)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pin(self, grid, value):
+        """ Store the output for grid outside the LRU"""
+        with self._lock:
+            self._pinned[self.key(grid)] = value
+
+    def stats(self) -> dict:
+        """ Size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "pinned": len(self._pinned),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": self.hits / lookups if lookups else 0.,
+            }
+
+    def clear(self):
+        """ Drop every entry, pinned ones included, e.g. after a model swap"""
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
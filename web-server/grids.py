@@ -0,0 +1,82 @@
+"""Decoding of the bit-packed 64x64 drawing grids sent by the ML-Draw client
+
+A grid is 512 bytes, one bit per pixel, row-major with the most significant
+bit first (the layout `Grid.tsx` builds and `np.unpackbits` reads).
+"""
+
+import numpy as np
+
+GRID_SIDE = 64
+GRID_BYTES = GRID_SIDE * GRID_SIDE // 8
+
+# Byte value -> its 8 pixels as 0/255 model inputs, so one np.take call
+# expands packed bytes straight into the float32 batch the model reads
+UNPACK_TABLE = 255. * np.unpackbits(
+    np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float32)
+
+
+def allocate_batch(max_batch_size):
+    """ Reusable float32 model input of shape [max_batch_size, 64, 64, 1]"""
+    return np.zeros((max_batch_size, GRID_SIDE, GRID_SIDE, 1), dtype=np.float32)
+
+
+def unpack_grid_into(grid, out):
+    """ Expands one 512-byte grid (any bytes-like object) into out, a [64, 64, 1] float32 view"""
+    packed = np.frombuffer(grid, dtype=np.uint8, count=GRID_BYTES)
+    np.take(UNPACK_TABLE, packed, axis=0,
+            out=out.reshape(GRID_BYTES, 8), mode='clip')
+
+
+def unpack_grids(grids, batch):
+    """ Expands a sequence of grids into the front of batch and returns that slice"""
+    for i, grid in enumerate(grids):
+        unpack_grid_into(grid, batch[i])
+    return batch[:len(grids)]
+
+
+def split_grids(payload):
+    """ Zero-copy 512-byte views over a payload of concatenated grids"""
+    if not payload or len(payload) % GRID_BYTES:
+        raise ValueError(
+            f"Payload of {len(payload)} bytes is not a whole number of {GRID_BYTES}-byte grids")
+    view = memoryview(payload)
+    return [view[start:start + GRID_BYTES] for start in range(0, len(payload), GRID_BYTES)]
+
+
+# Opcodes of the first byte of a streamed grid update
+FULL_FRAME = 0
+XOR_DELTA = 1
+SPARSE_XOR_DELTA = 2
+
+# One changed byte of a sparse update: little-endian byte index and its XOR mask
+SPARSE_ENTRY = np.dtype([('index', '<u2'), ('mask', 'u1')])
+
+
+def apply_grid_update(frame: np.ndarray, message):
+    """ Applies one streamed update to frame, a writable uint8 array of 512 bytes, in place.
+
+    The first byte of message is the opcode: FULL_FRAME followed by the 512
+    new bytes, XOR_DELTA followed by 512 bytes XORed into the frame, or
+    SPARSE_XOR_DELTA followed by any number of (uint16 index, uint8 mask) entries.
+    """
+    if not message:
+        raise ValueError("Empty grid update")
+    opcode, body = message[0], memoryview(message)[1:]
+
+    if opcode in (FULL_FRAME, XOR_DELTA):
+        if len(body) != GRID_BYTES:
+            raise ValueError(f"Expected {GRID_BYTES} bytes after the opcode")
+        update = np.frombuffer(body, dtype=np.uint8)
+        if opcode == FULL_FRAME:
+            frame[:] = update
+        else:
+            np.bitwise_xor(frame, update, out=frame)
+    elif opcode == SPARSE_XOR_DELTA:
+        if len(body) % SPARSE_ENTRY.itemsize:
+            raise ValueError("Sparse update is not a whole number of 3-byte entries")
+        entries = np.frombuffer(body, dtype=SPARSE_ENTRY)
+        if len(entries) and entries['index'].max() >= GRID_BYTES:
+            raise ValueError(f"Sparse update index out of range of {GRID_BYTES} bytes")
+        np.bitwise_xor.at(frame, entries['index'], entries['mask'])
+    else:
+        raise ValueError(f"Unknown grid update opcode {opcode}")
@@ -0,0 +1,241 @@
+"""Inference backends for the ML-Draw prediction server
+
+Every backend takes a float32 batch of shape [N, 64, 64, 1] holding 0/255
+pixels and returns the raw model output of shape [N, NUM_CLASSES]. Runtimes
+are imported when a backend is constructed, so the TFLite and ONNX Runtime
+backends never pull in the full Keras stack.
+"""
+
+import threading
+
+import numpy as np
+
+INPUT_SHAPE = (64, 64, 1)
+
+
+def served_batch_sizes(max_batch_size):
+    """ Powers of two up to and including max_batch_size"""
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_batch_size)
+    return tuple(sizes)
+
+
+def pad_batch(images, batch_sizes):
+    """ Zero-pads images up to the smallest batch size that fits them"""
+    num_images = len(images)
+    for size in batch_sizes:
+        if size >= num_images:
+            break
+    else:
+        return images
+
+    if size == num_images:
+        return images
+
+    padded = np.zeros((size,) + INPUT_SHAPE, dtype=np.float32)
+    padded[:num_images] = images
+    return padded
+
+
+class CompiledModel:
+    """Keras model behind a tf.function with a fixed [None, 64, 64, 1] float32 signature.
+
+    Calling it skips the tf.data pipeline and callback stack that model.predict
+    builds on every call. With jit_compile, XLA compiles one program per input
+    shape, so batches are padded up to the nearest warmed batch size.
+    """
+
+    def __init__(self, model, batch_sizes=(1,), jit_compile=False):
+        # pylint: disable-next=import-outside-toplevel
+        import tensorflow
+
+        self.model = model
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        self.jit_compile = jit_compile
+        self._forward = tensorflow.function(
+            self._call,
+            input_signature=[tensorflow.TensorSpec(
+                (None,) + INPUT_SHAPE, tensorflow.float32)],
+            jit_compile=jit_compile)
+
+    def _call(self, images):
+        return self.model(images, training=False)
+
+    def warmup(self):
+        """ Trace (and compile) the forward function for every served batch size"""
+        for size in self.batch_sizes:
+            self(np.zeros((size,) + INPUT_SHAPE, dtype=np.float32))
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        """ Returns the model output for a float32 batch of shape [N, 64, 64, 1]"""
+        num_images = len(images)
+        if self.jit_compile:
+            images = pad_batch(images, self.batch_sizes)
+
+        return self._forward(images).numpy()[:num_images]
+
+
+class InferenceBackend:
+    """Common interface of the inference backends"""
+
+    name = "base"
+
+    def __init__(self, model_path, batch_sizes=(1,)):
+        self.model_path = model_path
+        self.batch_sizes = tuple(sorted(batch_sizes))
+
+    def predict(self, images: np.ndarray) -> np.ndarray:
+        """ Returns the model output for a float32 batch of shape [N, 64, 64, 1]"""
+        raise NotImplementedError
+
+    def warmup(self):
+        """ Run one pass for every served batch size"""
+        for size in self.batch_sizes:
+            self.predict(np.zeros((size,) + INPUT_SHAPE, dtype=np.float32))
+
+    def summary(self):
+        """ Print a short description of the loaded model"""
+        print(f"{self.name} backend serving {self.model_path}")
+
+
+class KerasBackend(InferenceBackend):
+    """Full Keras model with the custom InceptionModule, run through CompiledModel"""
+
+    name = "keras"
+
+    def __init__(self, model_path="model.h5", batch_sizes=(1,), jit_compile=False,
+                 num_threads=None, inter_op_threads=None, **_):
+        super().__init__(model_path, batch_sizes)
+        # pylint: disable=import-outside-toplevel
+        import tensorflow
+        from inception_module import InceptionModule
+
+        # Must happen before TensorFlow creates its thread pools
+        if num_threads:
+            tensorflow.config.threading.set_intra_op_parallelism_threads(
+                num_threads)
+        if inter_op_threads:
+            tensorflow.config.threading.set_inter_op_parallelism_threads(
+                inter_op_threads)
+
+        self.model = tensorflow.keras.models.load_model(
+            model_path, custom_objects={"InceptionModule": InceptionModule})
+        self.compiled = CompiledModel(
+            self.model, batch_sizes=self.batch_sizes, jit_compile=jit_compile)
+
+    def predict(self, images):
+        return self.compiled(images)
+
+    def warmup(self):
+        self.compiled.warmup()
+
+    def summary(self):
+        self.model.summary()
+
+
+def _tflite_interpreter_class():
+    """ Prefer the standalone tflite_runtime wheel over the full TensorFlow package"""
+    # pylint: disable=import-outside-toplevel
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow
+        Interpreter = tensorflow.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteBackend(InferenceBackend):
+    """TFLite flatbuffer run by the multi-threaded (XNNPACK) CPU interpreter.
+
+    The interpreter has one set of tensor buffers, so batches are padded to the
+    served batch sizes and the input is only resized when that size changes.
+    Full-int8 models from python/quantize.py are quantized and dequantized here.
+    """
+
+    name = "tflite"
+
+    def __init__(self, model_path="model.tflite", batch_sizes=(1,), num_threads=None, **_):
+        super().__init__(model_path, batch_sizes)
+        interpreter_class = _tflite_interpreter_class()
+        self.interpreter = interpreter_class(
+            model_path=model_path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def _resize(self, batch_size):
+        if batch_size == self._batch_size:
+            return
+        self.interpreter.resize_tensor_input(
+            self._input['index'], (batch_size,) + INPUT_SHAPE)
+        self.interpreter.allocate_tensors()
+        self._batch_size = batch_size
+
+    def _quantize_input(self, images):
+        """ Full-int8 models take quantized pixels"""
+        if self._input['dtype'] == np.float32:
+            return images
+        scale, zero_point = self._input['quantization']
+        info = np.iinfo(self._input['dtype'])
+        return np.clip(np.round(images / scale + zero_point),
+                       info.min, info.max).astype(self._input['dtype'])
+
+    def _dequantize_output(self, output):
+        if self._output['dtype'] == np.float32:
+            return output
+        scale, zero_point = self._output['quantization']
+        return scale * (output.astype(np.float32) - zero_point)
+
+    def predict(self, images):
+        num_images = len(images)
+        images = self._quantize_input(pad_batch(images, self.batch_sizes))
+        with self._lock:
+            self._resize(len(images))
+            self.interpreter.set_tensor(self._input['index'], images)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self._output['index'])
+        return self._dequantize_output(output[:num_images])
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX export of the model run by ONNX Runtime on the CPU"""
+
+    name = "onnx"
+
+    def __init__(self, model_path="model.onnx", batch_sizes=(1,), num_threads=None, **_):
+        super().__init__(model_path, batch_sizes)
+        # pylint: disable-next=import-outside-toplevel
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self._input_name = self.session.get_inputs()[0].name
+
+    def predict(self, images):
+        return self.session.run(None, {self._input_name: images})[0]
+
+
+BACKENDS = {
+    backend.name: backend for backend in (KerasBackend, TFLiteBackend, OnnxBackend)
+}
+
+
+def load_backend(name, model_path=None, **options) -> InferenceBackend:
+    """ Builds the named backend, falling back to its default model file"""
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError as error:
+        raise ValueError(
+            f"Unknown inference backend {name!r}, expected one of {sorted(BACKENDS)}") from error
+
+    if model_path:
+        options['model_path'] = model_path
+    return backend_class(**options)
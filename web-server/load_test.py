@@ -0,0 +1,408 @@
+"""Load test for the ML-Draw prediction API
+
+Replays packed 64x64 grids against /prediction/, /prediction/binary and
+/ws/prediction at a fixed concurrency, either as fast as the server answers
+(closed loop) or at a fixed Poisson arrival rate (open loop), and writes
+throughput, p50/p95/p99 latency and errors per scenario as JSON so runs can
+be compared across commits.
+
+Grids come from the QuickDraw .bin files, rasterized like the training data
+(needs ../python/train_on_images.py and cairo), from a .npy of packed grids,
+or are random when neither is given. The server is either a running one
+(--url) or started in this process from server.py (--in-process), configured
+through the usual MLDRAW_* environment variables.
+
+A small replayed set would otherwise be answered from the prediction cache
+after the warmup, so unless --repeat-grids is given every request carries a
+unique grid: a request counter is XORed into the last bytes, the bottom-right
+pixels of the drawing. --in-process also runs the server with
+MLDRAW_CACHE_SIZE=0 unless it is set. The cache hit ratio of every scenario
+is in the report, it should be close to 0 for an inference benchmark.
+"""
+
+import argparse
+import asyncio
+import base64
+import http.client
+import itertools
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from grids import FULL_FRAME, GRID_BYTES, GRID_SIDE
+
+SCENARIOS = ("json", "binary", "websocket")
+# Rasters are antialiased, the front end grid is on/off
+PIXEL_THRESHOLD = 128
+# Bytes at the end of a grid the request counter is XORed into
+STAMP_BYTES = 4
+TRAINING_CODE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "python")
+
+
+def pack_rasters(rasters) -> np.ndarray:
+    """ [N, 64, 64] rasters into [N, 512] grids, MSB first and row-major like Grid.tsx"""
+    rasters = np.asarray(rasters).reshape(-1, GRID_SIDE, GRID_SIDE)
+    return np.packbits(rasters >= PIXEL_THRESHOLD, axis=-1).reshape(-1, GRID_BYTES)
+
+
+def grids_from_bin_files(bin_dir, num_grids) -> np.ndarray:
+    """ Round robin over the .bin files, rasterized with the training parameters"""
+    sys.path.insert(0, TRAINING_CODE_DIR)
+    # pylint: disable-next=import-error, import-outside-toplevel
+    from train_on_images import list_bin_files, unpack_drawings
+
+    drawings = [unpack_drawings(bin_file) for bin_file in list_bin_files(bin_dir)]
+    rasters = []
+    while drawings and len(rasters) < num_grids:
+        for drawing in list(drawings):
+            try:
+                rasters.append(next(drawing)[0])
+            except StopIteration:
+                drawings.remove(drawing)
+    return pack_rasters(rasters[:num_grids])
+
+
+def load_grids(args) -> np.ndarray:
+    """ The grids to replay, from --bin-dir, --grids or random bits"""
+    if args.bin_dir:
+        return grids_from_bin_files(args.bin_dir, args.num_grids)
+    if args.grids:
+        return np.load(args.grids).reshape(-1, GRID_BYTES)
+    rng = np.random.default_rng(args.seed)
+    return rng.integers(0, 256, size=(args.num_grids, GRID_BYTES), dtype=np.uint8)
+
+
+def stamp_grid(grid, number) -> bytes:
+    """ grid with number XORed into its last STAMP_BYTES bytes, unique per number"""
+    stamped = bytearray(grid)
+    stamp = number.to_bytes(STAMP_BYTES, "little")
+    for offset in range(STAMP_BYTES):
+        stamped[len(stamped) - STAMP_BYTES + offset] ^= stamp[offset]
+    return bytes(stamped)
+
+
+class Recorder:
+    """Latencies and error counts of one scenario, shared by its client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = {}
+
+    def record(self, latency, error=None):
+        """ One finished request, error is a status code or exception name"""
+        with self._lock:
+            if error is None:
+                self.latencies.append(latency)
+            else:
+                self.errors[str(error)] = self.errors.get(str(error), 0) + 1
+
+    def report(self, duration) -> dict:
+        """ Throughput, latency percentiles in milliseconds and error rate"""
+        latencies = 1000. * np.array(self.latencies)
+        errors = sum(self.errors.values())
+        total = len(latencies) + errors
+        report = {
+            "requests": total,
+            "duration_seconds": duration,
+            "throughput_rps": len(latencies) / duration if duration else 0.,
+            "errors": dict(self.errors),
+            "error_rate": errors / total if total else 0.,
+        }
+        if len(latencies):
+            report.update({
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "mean_ms": float(latencies.mean()),
+                "max_ms": float(latencies.max()),
+            })
+        return report
+
+
+class HttpClient:
+    """One keep-alive connection sending grids to /prediction/ or /prediction/binary"""
+
+    def __init__(self, url, scenario):
+        parsed = urllib.parse.urlsplit(url)
+        self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80)
+        self.scenario = scenario
+
+    def send(self, grid):
+        """ Returns None on success, else the HTTP status"""
+        if self.scenario == "json":
+            body = json.dumps({"binaryData": base64.b64encode(grid).decode()})
+            self.connection.request("POST", "/prediction/", body,
+                                    {"Content-Type": "application/json"})
+        else:
+            self.connection.request("POST", "/prediction/binary", grid,
+                                    {"Content-Type": "application/octet-stream"})
+        response = self.connection.getresponse()
+        response.read()
+        return None if response.status == 200 else response.status
+
+    def close(self):
+        """ Close the connection"""
+        self.connection.close()
+
+
+class WebSocketClient:
+    """One drawing session on /ws/prediction, sending full frames and awaiting each prediction"""
+
+    def __init__(self, url):
+        # pylint: disable-next=import-outside-toplevel
+        import websockets
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        uri = urllib.parse.urlsplit(url)._replace(scheme="ws", path="/ws/prediction").geturl()
+        self.websocket = self.loop.run_until_complete(
+            websockets.connect(uri, ping_interval=None, max_queue=None))
+        self.frames = 0
+
+    async def _send(self, grid):
+        await self.websocket.send(bytes([FULL_FRAME]) + grid)
+        self.frames += 1
+        while True:
+            response = json.loads(await self.websocket.recv())
+            if "Error" in response:
+                return response["Error"]
+            if response.get("Frame") == self.frames:
+                return None
+
+    def send(self, grid):
+        """ Returns None once the prediction of this frame arrives, else the server's error"""
+        return self.loop.run_until_complete(self._send(grid))
+
+    def close(self):
+        """ Close the session"""
+        self.loop.run_until_complete(self.websocket.close())
+        self.loop.close()
+
+
+def make_client(url, scenario):
+    """ Client for one of SCENARIOS"""
+    if scenario == "websocket":
+        return WebSocketClient(url)
+    return HttpClient(url, scenario)
+
+
+def close_quietly(client):
+    """ Close a client whose connection may already be broken"""
+    try:
+        client.close()
+    # pylint: disable-next=broad-except
+    except Exception:
+        pass
+
+
+# Numbers the stamped grids of every scenario and warmup of a run
+request_numbers = itertools.count(1)
+
+
+# pylint: disable-next=too-many-arguments
+def run_scenario(url, scenario, grids, concurrency, duration, rate=0., unique_grids=True):
+    """ Replay grids for duration seconds from concurrency clients.
+
+    With rate (requests per second) arrivals are scheduled up front and
+    latency counts from the scheduled time, so a slow server is not hidden by
+    clients waiting on it (coordinated omission). Without it every client
+    sends its next request as soon as the previous one is answered.
+    With unique_grids every request stamps its grid with a new number so
+    the server's prediction cache cannot answer it.
+    """
+    recorder = Recorder()
+    schedule = queue.Queue()
+    started = time.perf_counter()
+    deadline = started + duration
+
+    def client_loop(worker_id):
+        try:
+            client = make_client(url, scenario)
+        # pylint: disable-next=broad-except
+        except Exception as exception:
+            recorder.record(0., f"connect: {type(exception).__name__}")
+            return
+        sent = worker_id
+        try:
+            while True:
+                if rate:
+                    scheduled = schedule.get()
+                    if scheduled is None:
+                        return
+                    time.sleep(max(0., scheduled - time.perf_counter()))
+                else:
+                    scheduled = time.perf_counter()
+                    if scheduled >= deadline:
+                        return
+                grid = grids[sent % len(grids)].tobytes()
+                if unique_grids:
+                    grid = stamp_grid(grid, next(request_numbers))
+                sent += concurrency
+                try:
+                    error = client.send(grid)
+                # pylint: disable-next=broad-except
+                except Exception as exception:
+                    error = type(exception).__name__
+                    close_quietly(client)
+                    client = make_client(url, scenario)
+                recorder.record(time.perf_counter() - scheduled, error)
+        finally:
+            close_quietly(client)
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    if rate:
+        arrival = started
+        while True:
+            arrival += random.expovariate(rate)
+            if arrival >= deadline:
+                break
+            schedule.put(arrival)
+        for _ in threads:
+            schedule.put(None)
+
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.perf_counter() - started)
+
+
+def fetch_json(url, path):
+    """ GET a JSON endpoint of the server, None if it is not available"""
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=5)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        body = response.read()
+        return json.loads(body) if response.status == 200 else None
+    except (OSError, ValueError):
+        return None
+    finally:
+        connection.close()
+
+
+def wait_until_ready(url, timeout=300.):
+    """ Poll /readyz until the model is loaded"""
+    deadline = time.monotonic() + timeout
+    while fetch_json(url, "/readyz") is None:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} was not ready after {timeout} seconds")
+        time.sleep(.1)
+
+
+def start_in_process_server():
+    """ Serve server.app from a background thread on a free local port, returns its URL.
+
+    The prediction cache is off unless MLDRAW_CACHE_SIZE is set, so the run
+    measures inference.
+    """
+    os.environ.setdefault("MLDRAW_CACHE_SIZE", "0")
+    # pylint: disable-next=import-outside-toplevel
+    import uvicorn
+    # pylint: disable-next=import-outside-toplevel
+    import server
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    threading.Thread(target=uvicorn.Server(config).run, name="load-test-server",
+                     daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def cache_hit_ratio(before, after):
+    """ Cache hits over lookups between two /stats responses, None without them"""
+    if not before or not after:
+        return None
+    hits = after["cache"]["hits"] - before["cache"]["hits"]
+    lookups = hits + after["cache"]["misses"] - before["cache"]["misses"]
+    return hits / lookups if lookups else 0.
+
+
+def git_commit():
+    """ Commit of the working tree, to tell runs apart"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:4000")
+    target.add_argument("--in-process", action="store_true")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--bin-dir", help="Directory of QuickDraw .bin files")
+    source.add_argument("--grids", help=".npy of packed 512-byte grids")
+    parser.add_argument("--num-grids", type=int, default=1_000)
+    parser.add_argument("--repeat-grids", action="store_true",
+                        help="Replay the grids unchanged, letting the server cache answer repeats")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.,
+                        help="Seconds per scenario")
+    parser.add_argument("--rate", type=float, default=0.,
+                        help="Requests per second per scenario, 0 for closed loop")
+    parser.add_argument("--warmup", type=float, default=2., help="Seconds per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    replay_grids = load_grids(args)
+    server_url = start_in_process_server() if args.in_process else args.url
+    wait_until_ready(server_url)
+
+    results = {}
+    for name in args.scenarios:
+        if args.warmup:
+            run_scenario(server_url, name, replay_grids, args.concurrency, args.warmup,
+                         unique_grids=not args.repeat_grids)
+        stats_before = fetch_json(server_url, "/stats")
+        results[name] = run_scenario(server_url, name, replay_grids, args.concurrency,
+                                     args.duration, args.rate, unique_grids=not args.repeat_grids)
+        results[name]["cache_hit_ratio"] = cache_hit_ratio(stats_before, fetch_json(server_url, "/stats"))
+        print(f"{name}: {results[name]['throughput_rps']:.1f} req/s, "
+              f"p99 {results[name].get('p99_ms', float('nan')):.2f} ms, "
+              f"cache hit ratio {results[name]['cache_hit_ratio']}", file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "config": {
+            "url": None if args.in_process else args.url,
+            "in_process": args.in_process,
+            "grids": len(replay_grids),
+            "grid_source": args.bin_dir or args.grids or "random",
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "rate_rps": args.rate,
+            "unique_grids": not args.repeat_grids,
+            "server_env": {key: value for key, value in os.environ.items()
+                           if key.startswith("MLDRAW_")},
+        },
+        "server": fetch_json(server_url, "/readyz"),
+        "scenarios": results,
+        "server_stats": fetch_json(server_url, "/stats"),
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
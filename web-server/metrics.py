@@ -0,0 +1,150 @@
+"""Prometheus-style metrics for the ML-Draw prediction server
+
+Just enough of the text exposition format for counters, gauges and
+histograms, without a client library dependency. Every metric registers
+itself in REGISTRY, which `render` writes out for the /metrics endpoint.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from 50 microseconds (decoding a grid) to 2.5 seconds (a slow batch)
+LATENCY_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025,
+                   .05, .1, .25, .5, 1., 2.5)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Metric:
+    """Named metric with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> tuple:
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """ (suffix, labels, value) triples of the current values"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """ Text exposition of this metric"""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(labels)} {float(value)!r}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """ Add amount to the count of this label set"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [("", key, value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """Value read from a callback at scrape time.
+
+    The callback returns a number, or a dict mapping label value tuples to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, read, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if not isinstance(value, dict):
+            return [("", (), value)]
+        return [("", tuple(zip(self.label_names, label_values)), sample)
+                for label_values, sample in value.items()]
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """ Record one observation for this label set"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum of observations
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the wall time of the with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", key + (("le", le),), cumulative))
+            samples.append(("_sum", key, counts[-1]))
+            samples.append(("_count", key, cumulative))
+        return samples
+
+
+def render() -> str:
+    """ Text exposition of every registered metric"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
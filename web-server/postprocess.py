@@ -0,0 +1,30 @@
+"""Post-processing of model outputs for the ML-Draw prediction server
+
+The model's final Dense layer has no activation, so its outputs are logits.
+"""
+
+import numpy as np
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    """ Class probabilities along the last axis"""
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def top_k(logits: np.ndarray, k: int):
+    """ Classes and probabilities of the k most likely classes of each row, most likely first.
+
+    Takes a [N, NUM_CLASSES] (or single [NUM_CLASSES]) array of logits and
+    returns two [N, k] arrays. Only the k selected entries are sorted.
+    """
+    probabilities = softmax(np.atleast_2d(logits))
+    k = min(k, probabilities.shape[-1])
+
+    candidates = np.argpartition(probabilities, -k, axis=-1)[:, -k:]
+    candidate_probabilities = np.take_along_axis(
+        probabilities, candidates, axis=-1)
+
+    order = np.argsort(-candidate_probabilities, axis=-1)
+    return (np.take_along_axis(candidates, order, axis=-1),
+            np.take_along_axis(candidate_probabilities, order, axis=-1))
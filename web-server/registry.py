@@ -0,0 +1,207 @@
+"""Versioned model registry for the ML-Draw prediction server
+
+Each loaded model version owns its micro-batcher. The registry routes every
+prediction to the active version, or to a candidate version for a canary
+share of traffic, and can mirror requests to a shadow candidate. Swapping the
+active version is atomic for new requests, while the old version drains its
+in-flight requests in the background before it is closed.
+"""
+
+import random
+import threading
+import time
+import traceback
+
+CANARY = "canary"
+SHADOW = "shadow"
+
+
+class ModelVersion:
+    """One loaded model and its batcher, counting in-flight requests so it can drain"""
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, name, model_path, batcher, close=None, health=None):
+        self.name = name
+        self.model_path = model_path
+        self.batcher = batcher
+        self.loaded_at = time.time()
+        self._close = close
+        self._health = health
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._idle = threading.Event()
+        self._idle.set()
+
+    @property
+    def in_flight(self) -> int:
+        """ Requests submitted to this version and not finished yet"""
+        return self._in_flight
+
+    @property
+    def healthy(self) -> bool:
+        """ Whatever runs the model can still serve, always true without a health check"""
+        return self._health is None or self._health()
+
+    def _started(self):
+        with self._lock:
+            self._in_flight += 1
+            self._idle.clear()
+
+    def submit(self, grid):
+        """ Submit one grid to this version's batcher"""
+        self._started()
+        try:
+            future = self.batcher.submit(grid)
+        except Exception:
+            self._finished(None)
+            raise
+        future.add_done_callback(self._finished)
+        return future
+
+    def predict_batch(self, grids):
+        """ Run a full batch straight through the model, bypassing the batcher queue"""
+        self._started()
+        try:
+            return self.batcher.predict_batch(grids)
+        finally:
+            self._finished(None)
+
+    def hold(self):
+        """ Count a request spanning many batches as in flight until release, so a swap drains it"""
+        self._started()
+
+    def release(self):
+        """ End a request started with hold"""
+        self._finished(None)
+
+    def _finished(self, _):
+        with self._lock:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.set()
+
+    def retire(self, drain_timeout=30.):
+        """ Wait for in-flight requests (up to drain_timeout seconds), then free the model"""
+        self._idle.wait(drain_timeout)
+        self.batcher.close()
+        if self._close is not None:
+            self._close()
+
+    def describe(self) -> dict:
+        """ Name, file and load state of this version"""
+        return {
+            "name": self.name,
+            "path": self.model_path,
+            "loaded_at": self.loaded_at,
+            "in_flight": self._in_flight,
+            "healthy": self.healthy,
+        }
+
+
+class ModelRegistry:
+    """Active and candidate model versions, with canary or shadow routing of the candidate"""
+
+    def __init__(self, drain_timeout=30.):
+        self.drain_timeout = drain_timeout
+        self.active = None
+        self.candidate = None
+        self.candidate_mode = None
+        self.candidate_percent = 0.
+        self.loading = {}
+        self._lock = threading.Lock()
+
+    def _retire(self, version):
+        if version is not None:
+            threading.Thread(target=version.retire, args=(self.drain_timeout,),
+                             name=f"retire-{version.name}", daemon=True).start()
+
+    def activate(self, version):
+        """ Route all new requests to version and drain the previously active one"""
+        with self._lock:
+            previous, self.active = self.active, version
+            if self.candidate is version:
+                self.candidate = self.candidate_mode = None
+        self._retire(previous)
+
+    def hold_active(self):
+        """ The active version, held in flight until its release, for requests of many batches"""
+        with self._lock:
+            version = self.active
+            version.hold()
+        return version
+
+    def set_candidate(self, version, mode=CANARY, percent=0.):
+        """ Send percent of requests to version (canary) or mirror every request to it (shadow)"""
+        if mode not in (CANARY, SHADOW):
+            raise ValueError(f"Candidate mode must be {CANARY!r} or {SHADOW!r}")
+        with self._lock:
+            previous, self.candidate = self.candidate, version
+            self.candidate_mode = mode
+            self.candidate_percent = percent
+        if previous is not version:
+            self._retire(previous)
+
+    def drop_candidate(self):
+        """ Stop routing to the candidate and drain it"""
+        with self._lock:
+            previous, self.candidate = self.candidate, None
+            self.candidate_mode = None
+        self._retire(previous)
+
+    def load_in_background(self, name, build_version, install):
+        """ Build (and warm) a version off the request path, then hand it to install"""
+        def load():
+            self.loading[name] = "loading"
+            try:
+                version = build_version()
+                install(version)
+            # pylint: disable-next=broad-except
+            except Exception:
+                traceback.print_exc()
+                self.loading[name] = "failed"
+                return
+            del self.loading[name]
+
+        threading.Thread(target=load, name=f"load-{name}", daemon=True).start()
+
+    def submit(self, grid):
+        """ Route one grid, returning (future, version it ran on, shadow future or None, shadow version or None)"""
+        with self._lock:
+            version = self.active
+            shadow = None
+            if self.candidate is not None:
+                if self.candidate_mode == CANARY:
+                    if random.random() * 100. < self.candidate_percent:
+                        version = self.candidate
+                else:
+                    shadow = self.candidate
+
+            future = version.submit(grid)
+            shadow_future = None
+            if shadow is not None:
+                try:
+                    shadow_future = shadow.submit(grid)
+                # pylint: disable-next=broad-except
+                except Exception:
+                    # Shadow traffic must never fail the real request
+                    shadow = None
+        return future, version, shadow_future, shadow
+
+    def close(self):
+        """ Drain and free every version"""
+        with self._lock:
+            versions = [self.active, self.candidate]
+            self.active = self.candidate = None
+        for version in versions:
+            if version is not None:
+                version.retire(self.drain_timeout)
+
+    def describe(self) -> dict:
+        """ Active and candidate versions and versions still loading"""
+        with self._lock:
+            return {
+                "active": self.active.describe() if self.active else None,
+                "candidate": dict(self.candidate.describe(), mode=self.candidate_mode,
+                                  percent=self.candidate_percent) if self.candidate else None,
+                "loading": dict(self.loading),
+            }
@@ -1,21 +1,73 @@
 """Test REST API Server for ML-Draw"""
 
+import asyncio
 import base64
+import json
+import logging
+import os
+import random
+import threading
 import traceback
 import sys
+import time
+from contextlib import asynccontextmanager
 import uvicorn
 import numpy as np
-import tensorflow
 from numpy import array
 import inflect
-from fastapi import FastAPI
+from fastapi import (FastAPI, HTTPException, Query, Request, Response, WebSocket,
+                     WebSocketDisconnect)
 from fastapi.middleware.cors import CORSMiddleware
-from inception_module import InceptionModule
-
-np.set_printoptions(threshold=sys.maxsize, linewidth=250)
+from fastapi.responses import StreamingResponse
+from starlette.requests import ClientDisconnect
+from concurrent.futures import Future
+from batching import MicroBatcher, Overloaded
+from cache import PredictionCache
+from grids import (GRID_BYTES, allocate_batch, apply_grid_update, split_grids,
+                   unpack_grids)
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, render
+from postprocess import top_k
+from registry import CANARY, SHADOW, ModelRegistry, ModelVersion
+from worker_pool import WorkerPool
+from inference import load_backend, served_batch_sizes
+
+PROCESS_STARTED = time.perf_counter()
+L = logging.getLogger(__name__)
 
 BIN_DIR_FILE_LOC = "./binary_images"
 NUM_CLASSES = 121
+MAX_BATCH_SIZE = int(os.environ.get("MLDRAW_MAX_BATCH_SIZE", "32"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MLDRAW_MAX_BATCH_WAIT_MS", "5"))
+XLA_JIT = os.environ.get("MLDRAW_XLA_JIT", "0") == "1"
+# One of "keras", "tflite" or "onnx", see inference.BACKENDS
+MODEL_BACKEND = os.environ.get("MLDRAW_BACKEND", "keras")
+MODEL_PATH = os.environ.get("MLDRAW_MODEL_PATH")
+# Intra-op threads of one inference call, and TensorFlow's inter-op threads
+NUM_THREADS = int(os.environ.get("MLDRAW_NUM_THREADS", "0")) or None
+INTER_OP_THREADS = int(os.environ.get("MLDRAW_INTER_OP_THREADS", "0")) or None
+# Threads running batches concurrently, each with its own input buffer
+INFERENCE_WORKERS = int(os.environ.get("MLDRAW_INFERENCE_WORKERS", "1"))
+# Inference processes sharing the model file, 0 to run the model in this process.
+# Use with MLDRAW_BACKEND=tflite so the workers map one copy of the weights
+PROCESS_WORKERS = int(os.environ.get("MLDRAW_PROCESS_WORKERS", "0"))
+# Longest one batch may take in a worker process before it is killed and restarted
+WORKER_TIMEOUT_SECONDS = float(os.environ.get("MLDRAW_WORKER_TIMEOUT_SECONDS", "30"))
+# Queued predictions before new ones are shed with 503, 0 for no limit
+MAX_QUEUE_SIZE = int(os.environ.get("MLDRAW_MAX_QUEUE_SIZE", "256"))
+REQUEST_TIMEOUT_SECONDS = float(
+    os.environ.get("MLDRAW_REQUEST_TIMEOUT_SECONDS", "2"))
+CACHE_SIZE = int(os.environ.get("MLDRAW_CACHE_SIZE", "10000"))
+CACHE_TTL_SECONDS = float(os.environ.get("MLDRAW_CACHE_TTL_SECONDS", "0")) or None
+# Checkpoints that can be hot swapped in through /models
+MODEL_DIR = os.environ.get("MLDRAW_MODEL_DIR", ".inception")
+MODEL_ADMIN = os.environ.get("MLDRAW_MODEL_ADMIN", "0") == "1"
+# Longest a replaced model version keeps serving its in-flight requests
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("MLDRAW_DRAIN_TIMEOUT_SECONDS", "30"))
+# Fraction of decoded grids written to the debug log
+GRID_LOG_SAMPLE_RATE = float(os.environ.get("MLDRAW_GRID_LOG_SAMPLE_RATE", "0"))
+# Longest string of a JSON /prediction/bulk body, a 512-byte grid is 684 base64 characters
+MAX_JSON_GRID_CHARS = 2048
+JSON_WHITESPACE = b" \t\r\n"
 
 LABEL_TO_NUM_MAP = {
     "airplane": 0,
@@ -142,20 +194,281 @@ LABEL_TO_NUM_MAP = {
 }
 
 
-def is_plural(word):
-    """ Decides if word is plural or not"""
+CLASS_LABELS = tuple(sorted(LABEL_TO_NUM_MAP, key=LABEL_TO_NUM_MAP.get))
+PROPER_NOUNS = (64, 100)
+
+
+def build_response_phrases():
+    """ Final response string of every class, indexed by class number"""
     p_engine = inflect.engine()
-    singular_form = p_engine.singular_noun(word)
-    print(singular_form, singular_form is not False)
-    return singular_form is not False
+
+    phrases = []
+    for input_num, label in enumerate(CLASS_LABELS):
+        if p_engine.singular_noun(label) is not False:
+            phrases.append("I think you are drawing " + label)
+        elif input_num in PROPER_NOUNS:
+            phrases.append("I think you are drawing the " +
+                           label[0].upper() + label[1:])
+        elif label[0].lower() in 'aeiou':
+            phrases.append("I think you are drawing an " + label)
+        else:
+            phrases.append("I think you are drawing a " + label)
+    return tuple(phrases)
+
+
+RESPONSE_PHRASES = build_response_phrases()
+
+
+def response_phrase(input_num) -> str:
+    """ Response string for a class number, "Unknown" when out of range"""
+    if 0 <= input_num < len(RESPONSE_PHRASES):
+        return RESPONSE_PHRASES[input_num]
+    return "Unknown"
+
+
+REQUESTS = Counter("mldraw_requests_total", "HTTP requests by route and status",
+                   ("endpoint", "status"))
+ERRORS = Counter("mldraw_errors_total",
+                 "Failed predictions by stage", ("stage",))
+WEBSOCKET_FRAMES = Counter("mldraw_websocket_frames_total",
+                           "Grid updates received over WebSocket")
+BULK_GRIDS = Counter("mldraw_bulk_grids_total", "Grids scored through /prediction/bulk")
+STAGE_SECONDS = Histogram("mldraw_stage_seconds",
+                          "Time spent in each prediction stage", label_names=("stage",))
+VERSION_SECONDS = Histogram("mldraw_version_prediction_seconds",
+                            "Time from submitting a grid to its model output, per model version",
+                            label_names=("version",))
+SHADOW_AGREEMENT = Counter("mldraw_shadow_agreement_total",
+                           "Shadow candidate predictions matching the served class", ("result",))
+BATCH_SIZE = Histogram("mldraw_batch_size", "Grids per model forward pass",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+def sample_grid(grid):
+    """ Occasionally log a decoded grid, instead of printing every one"""
+    if GRID_LOG_SAMPLE_RATE and random.random() < GRID_LOG_SAMPLE_RATE:
+        L.debug("Sampled grid:\n%s", np.array2string(
+            np.unpackbits(np.frombuffer(grid, dtype=np.uint8)).reshape(64, 64),
+            threshold=sys.maxsize, max_line_width=250))
+
+
+BACKEND_OPTIONS = {
+    "batch_sizes": served_batch_sizes(MAX_BATCH_SIZE),
+    "jit_compile": XLA_JIT,
+    "num_threads": NUM_THREADS,
+    "inter_op_threads": INTER_OP_THREADS,
+}
+
+model_registry = ModelRegistry(drain_timeout=DRAIN_TIMEOUT_SECONDS)
+serving_ready = threading.Event()
+startup_error = None
+STARTUP_SECONDS = {}
+
+prediction_cache = PredictionCache(
+    max_size=CACHE_SIZE, ttl_seconds=CACHE_TTL_SECONDS)
+
+EMPTY_GRID = bytes(GRID_BYTES)
+
+
+def build_version(name, model_path, timings=None) -> ModelVersion:
+    """ Loads and warms one model version behind its own micro-batcher"""
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    if PROCESS_WORKERS:
+        # Workers are forked from this (loader) thread and run their own warmup
+        worker_pool = WorkerPool(PROCESS_WORKERS, MODEL_BACKEND, model_path,
+                                 max_batch_size=MAX_BATCH_SIZE, num_classes=NUM_CLASSES,
+                                 timeout=WORKER_TIMEOUT_SECONDS, **BACKEND_OPTIONS)
+        timings["model_load"] = time.perf_counter() - started
+        worker_pool.summary()
+
+        def run_model(grids):
+            # Workers build their own input batch, this times the round trip
+            with STAGE_SECONDS.time(stage="inference"):
+                return worker_pool.predict(grids)
+        close = worker_pool.close
+
+        def health():
+            return worker_pool.healthy
+    else:
+        model = load_backend(MODEL_BACKEND, model_path, **BACKEND_OPTIONS)
+        timings["model_load"] = time.perf_counter() - started
+        if L.isEnabledFor(logging.DEBUG):
+            model.summary()
+
+        started = time.perf_counter()
+        model.warmup()
+        timings["warmup"] = time.perf_counter() - started
+
+        # One reusable input batch per batcher thread
+        input_buffers = threading.local()
+
+        def run_model(grids):
+            if not hasattr(input_buffers, 'batch'):
+                input_buffers.batch = allocate_batch(MAX_BATCH_SIZE)
+            with STAGE_SECONDS.time(stage="tensor_build"):
+                batch = unpack_grids(grids, input_buffers.batch)
+            with STAGE_SECONDS.time(stage="inference"):
+                return model.predict(batch)
+        close = health = None
+
+    def predict_batch(grids):
+        """ Runs a list of 512-byte packed grids through the model in one forward pass"""
+        BATCH_SIZE.observe(len(grids))
+        try:
+            return run_model(grids)
+        except Exception:
+            ERRORS.inc(stage="inference")
+            raise
+
+    batcher = MicroBatcher(predict_batch, max_batch_size=MAX_BATCH_SIZE,
+                           max_wait_ms=MAX_BATCH_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE,
+                           num_workers=max(INFERENCE_WORKERS, PROCESS_WORKERS))
+    return ModelVersion(name, model_path, batcher, close=close, health=health)
+
+
+def activate_version(version):
+    """ Swap version in for new requests, re-seeding the cache with its outputs"""
+    # The empty canvas is the most common grid, answer it from the cache from the start
+    empty_output = version.batcher.predict(EMPTY_GRID)
+    model_registry.activate(version)
+    prediction_cache.clear()
+    prediction_cache.pin(EMPTY_GRID, empty_output)
+
+
+def start_serving():
+    """ Loads and warms the model off the event loop, recording how long each step took"""
+    # pylint: disable-next=global-statement
+    global startup_error
+    try:
+        version = build_version(
+            os.path.basename(MODEL_PATH) if MODEL_PATH else MODEL_BACKEND,
+            MODEL_PATH, STARTUP_SECONDS)
+
+        started = time.perf_counter()
+        activate_version(version)
+        STARTUP_SECONDS["first_prediction"] = time.perf_counter() - started
+    # pylint: disable-next=broad-except
+    except Exception as error:
+        startup_error = error
+        L.exception("Model failed to load")
+        return
+
+    STARTUP_SECONDS["total"] = time.perf_counter() - PROCESS_STARTED
+    serving_ready.set()
+    L.info("Ready to serve predictions, startup took %s", STARTUP_SECONDS)
+
+
+# pylint: disable-next=too-many-arguments
+def record_version_outcome(version, future, shadow, shadow_future, submitted):
+    """ Per-version latency, of the shadow candidate too, and its agreement with the served answer"""
+    def observe_latency(name):
+        def observe(done):
+            if not done.cancelled() and done.exception() is None:
+                VERSION_SECONDS.observe(time.perf_counter() - submitted, version=name)
+        return observe
+
+    future.add_done_callback(observe_latency(version.name))
+    if shadow_future is None:
+        return
+    shadow_future.add_done_callback(observe_latency(shadow.name))
+
+    def compare(_):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if shadow_future.cancelled() or shadow_future.exception() is not None:
+            return
+        agrees = np.argmax(future.result()) == np.argmax(
+            shadow_future.result())
+        SHADOW_AGREEMENT.inc(result="agree" if agrees else "disagree")
+
+    # Runs exactly once, after both outputs are in
+    shadow_future.add_done_callback(lambda _: future.add_done_callback(compare))
+
+
+def submit_grid(grid) -> Future:
+    """ Future of the model logits for one packed grid, served from the cache when possible"""
+    output = prediction_cache.get(grid)
+    if output is not None:
+        future = Future()
+        future.set_result(output)
+        return future
+
+    # The request buffer is only valid until the response, keep our own copy for the key
+    grid = bytes(grid)
+    submitted = time.perf_counter()
+    future, version, shadow_future, shadow = model_registry.submit(grid)
+    record_version_outcome(version, future, shadow, shadow_future, submitted)
+
+    def store(done):
+        # Only outputs of the version currently active belong in the cache
+        if version is model_registry.active and not done.cancelled() and done.exception() is None:
+            prediction_cache.put(grid, done.result().copy())
+
+    future.add_done_callback(store)
+    return future
+
+
+async def predict_grids(grids) -> list:
+    """ Logits of every grid, awaited without blocking the event loop.
+
+    Sheds the request with 503 when the batcher queue is full, and gives up
+    with 504 (dropping whatever is still queued) after REQUEST_TIMEOUT_SECONDS.
+    """
+    if not serving_ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is not loaded yet")
+
+    futures = []
+    try:
+        for grid in grids:
+            futures.append(submit_grid(grid))
+    except Overloaded as error:
+        for future in futures:
+            future.cancel()
+        raise HTTPException(status_code=503, detail=str(error)) from error
+
+    try:
+        return await asyncio.wait_for(
+            asyncio.gather(*(asyncio.wrap_future(future)
+                           for future in futures)),
+            REQUEST_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError as error:
+        raise HTTPException(
+            status_code=504, detail="Prediction timed out") from error
+
+
+def batcher_stats() -> dict:
+    """ Batcher statistics of every loaded version, keyed by version name"""
+    versions = (model_registry.active, model_registry.candidate)
+    return {version.name: version.batcher.stats() for version in versions if version is not None}
+
+
+Gauge("mldraw_queue_depth", "Predictions waiting for the batcher",
+      lambda: {(name, ): stats["queue_depth"] for name, stats in batcher_stats().items()},
+      ("version",))
+Gauge("mldraw_requests_shed", "Predictions rejected or dropped by the batcher",
+      lambda: {(name, reason): stats[reason] for name, stats in batcher_stats().items()
+               for reason in ("rejected", "cancelled")}, ("version", "reason"))
+Gauge("mldraw_cache_hit_ratio", "Prediction cache hits over lookups",
+      lambda: prediction_cache.stats()["hit_ratio"])
+Gauge("mldraw_cache_events", "Prediction cache hits, misses, evictions and expirations",
+      lambda: {(result,): prediction_cache.stats()[result]
+               for result in ("hits", "misses", "evictions", "expirations")}, ("event",))
+Gauge("mldraw_model_backend_info", "Inference backend serving predictions",
+      lambda: {(MODEL_BACKEND, str(PROCESS_WORKERS)): 1}, ("backend", "process_workers"))
 
 
-model = tensorflow.keras.models.load_model('model.h5', custom_objects={
-                                           "InceptionModule": InceptionModule})
 
-model.summary()
+@asynccontextmanager
+async def lifespan(_app):
+    """ Accept connections (and health checks) while the model loads in the background"""
+    threading.Thread(target=start_serving, name="model-loader",
+                     daemon=True).start()
+    yield
+    model_registry.close()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 
 origins = [
@@ -173,6 +486,20 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    """ Request counts by route template and status code"""
+    try:
+        response = await call_next(request)
+    except Exception:
+        ERRORS.inc(stage="request")
+        raise
+    route = request.scope.get("route")
+    REQUESTS.inc(endpoint=route.path if route else "unmatched",
+                 status=str(response.status_code))
+    return response
+
+
 def convert_bytes_to_uint8_array(data_bytes: str) -> array:
     """Convert String Bytes into a np uint8 array of size 64 by 64"""
 
@@ -192,11 +519,39 @@ def convert_bytes_to_uint8_array(data_bytes: str) -> array:
 
     # Convert the binary values to boolean values
     bool_array = bool_array.astype(np.uint8)
-    print(bool_array)
 
     return bool_array
 
 
+def decode_grid(data_bytes: str) -> bytes:
+    """Base64 String Bytes into the 512-byte packed grid"""
+    with STAGE_SECONDS.time(stage="decode"):
+        decoded_bytes = base64.b64decode(data_bytes)
+    if len(decoded_bytes) < GRID_BYTES:
+        raise HTTPException(
+            status_code=400, detail=f"Expected {GRID_BYTES} bytes of grid data")
+    sample_grid(decoded_bytes[:GRID_BYTES])
+    return decoded_bytes[:GRID_BYTES]
+
+
+@app.get("/healthz")
+def read_liveness():
+    """ Liveness probe, fails only if the model could not be loaded at all"""
+    if startup_error is not None:
+        return Response(content=repr(startup_error), status_code=500)
+    return {"Status": "alive"}
+
+
+@app.get("/readyz")
+def read_readiness():
+    """ Readiness probe, succeeds once the model is loaded and warmed"""
+    if not serving_ready.is_set():
+        return Response(content="loading", status_code=503)
+    if not model_registry.active.healthy:
+        return Response(content="inference workers failed", status_code=503)
+    return {"Status": "ready", "StartupSeconds": STARTUP_SECONDS}
+
+
 @app.get('/')
 def read_root():
     """Default for reat root"""
@@ -212,73 +567,394 @@ def read_all_categories():
 @app.get("/categories/{input_num}")
 def read_specific_category(input_num: int):
     """ Returns correct format input based on input number"""
-    inverse_map = {value: key for key, value in LABEL_TO_NUM_MAP.items()}
-    proper_nouns_list = [64, 100]
-
-    def isVowel(char):
-        """ Check to see if char is vowel"""
-        return char.lower() in 'aeiou'
-
-    response_string = inverse_map.get(input_num, "Unknown")
-
-    if response_string == "Unknown":
-        return {"Response": response_string}
+    return {"Response": response_phrase(input_num)}
 
-    if is_plural(response_string):
-        return {"Response": "I think you are drawing " + response_string}
 
-    if input_num in proper_nouns_list:
-        return {"Response": "I think you are drawing the " + response_string[0].upper() + response_string[1:]}
+@app.get("/phrases")
+def read_all_phrases():
+    """ Every response string at once, indexed by class number"""
+    return {"Phrases": RESPONSE_PHRASES}
 
-    if isVowel(response_string[0]):
 
-        return {"Response": "I think you are drawing an " + response_string}
+def format_prediction(output_array, top_k_classes=0, min_probability=0.) -> dict:
+    """ JSON response for the logits of one grid, see read_prediction"""
+    with STAGE_SECONDS.time(stage="postprocess"):
+        input_num = np.argmax(output_array)
+        if top_k_classes:
+            classes, probabilities = top_k(output_array, top_k_classes)
 
-    return {"Response": "I think you are drawing a " + response_string}
+    with STAGE_SECONDS.time(stage="format"):
+        response = {"Response": response_phrase(input_num)}
+        if top_k_classes:
+            response["Predictions"] = [
+                {"Class": int(class_num), "Label": CLASS_LABELS[class_num],
+                 "Probability": float(probability)}
+                for class_num, probability in zip(classes[0], probabilities[0])
+                if probability >= min_probability
+            ]
+    return response
 
 
 @app.post("/prediction/")
-def read_prediction(payload: dict):
-    """ Converts byte data into a prediction"""
-    bool_array = convert_bytes_to_uint8_array(payload.get('binaryData'))
-    print(bool_array)
-    bool_tensor = tensorflow.reshape(
-        tensorflow.convert_to_tensor(255*bool_array), [1, 64, 64, 1])
+async def read_prediction(payload: dict, top_k_classes: int = Query(0, alias="top_k", ge=0),
+                          min_probability: float = 0.):
+    """ Converts byte data into a prediction
+
+    With top_k, "Predictions" also lists the k most likely classes with their
+    softmax probabilities, leaving out any below min_probability.
+    """
+    grid = decode_grid(payload.get('binaryData'))
 
     try:
-        output_array = np.exp(model.predict(bool_tensor))
-        print(output_array, output_array.shape)
-        input_num = np.argmax(output_array.flatten())
+        output_array, = await predict_grids([grid])
+    except HTTPException:
+        raise
     # pylint: disable=bare-except
     except:
         traceback.print_exc()
-        input_num = -1
-
-    print(input_num)
+        return {"Response": response_phrase(-1)}
 
-    inverse_map = {value: key for key, value in LABEL_TO_NUM_MAP.items()}
-    proper_nouns_list = [64, 100]
+    return format_prediction(output_array, top_k_classes, min_probability)
 
-    def is_vowel(char):
-        """ Check to see if char is vowel"""
-        return char.lower() in 'aeiou'
 
-    response_string = inverse_map.get(input_num, "Unknown")
+@app.post("/prediction/binary")
+async def read_binary_prediction(request: Request,
+                                 top_k_classes: int = Query(0, alias="top_k", ge=0)):
+    """ Raw application/octet-stream body of one or more concatenated 512-byte grids.
 
-    if response_string == "Unknown":
-        return {"Response": response_string}
-
-    if is_plural(response_string):
-        return {"Response": "I think you are drawing " + response_string}
+    Responds with one uint8 class number per grid, in the same order. With
+    top_k, responds with the k most likely uint8 class numbers of every grid
+    followed by their little-endian float32 probabilities, both [N, k].
+    More grids than MLDRAW_MAX_QUEUE_SIZE could never be queued at once and
+    are refused with 413, /prediction/bulk scores any number of them.
+    """
+    try:
+        with STAGE_SECONDS.time(stage="decode"):
+            grids = split_grids(await request.body())
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+    if MAX_QUEUE_SIZE and len(grids) > MAX_QUEUE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{len(grids)} grids is more than the {MAX_QUEUE_SIZE} one request can queue, "
+                   "send them to /prediction/bulk")
+
+    outputs = np.stack(await predict_grids(grids))
+
+    with STAGE_SECONDS.time(stage="postprocess"):
+        if top_k_classes:
+            classes, probabilities = top_k(outputs, top_k_classes)
+        else:
+            classes = np.argmax(outputs, axis=1)
+
+    with STAGE_SECONDS.time(stage="format"):
+        content = classes.astype(np.uint8).tobytes()
+        if top_k_classes:
+            content += probabilities.astype('<f4').tobytes()
+
+    return Response(content=content, media_type="application/octet-stream")
+
+
+async def read_grid_batches(chunks, batch_size):
+    """ Full batches of 512-byte grids from an async iterator of byte chunks of any size"""
+    batch_bytes = batch_size * GRID_BYTES
+    buffer = bytearray()
+    failure = None
+    try:
+        async for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= batch_bytes:
+                yield split_grids(bytes(buffer[:batch_bytes]))
+                del buffer[:batch_bytes]
+    except ValueError as error:
+        failure = error
+    # The whole grids read before malformed input or a trailing partial grid still get scored
+    whole = len(buffer) - len(buffer) % GRID_BYTES
+    if whole:
+        yield split_grids(bytes(buffer[:whole]))
+    if failure is not None:
+        raise failure
+    if len(buffer) > whole:
+        raise ValueError(f"Body ends with {len(buffer) - whole} bytes of a partial {GRID_BYTES}-byte grid")
+
+
+async def json_grid_chunks(chunks):
+    """ The grids of a streamed JSON array of base64 strings, one grid per chunk.
+
+    Parsed as the body arrives, so only the string being read is held in
+    memory, and no string may be longer than MAX_JSON_GRID_CHARS.
+    """
+    buffer = b""
+    position = 0
+    state = "start"
+    async for chunk in chunks:
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+            token = buffer[position:position + 1]
+            if state == "end":
+                raise ValueError("Unexpected data after the JSON array")
+            if state == "start":
+                if token != b"[":
+                    raise ValueError("Expected a JSON array of base64 encoded grids")
+                position += 1
+                state = "first"
+            elif state == "separator" or (state == "first" and token == b"]"):
+                if token not in (b",", b"]"):
+                    raise ValueError("Expected , or ] between the grids of the JSON array")
+                position += 1
+                state = "value" if token == b"," else "end"
+            else:
+                if token != b'"':
+                    raise ValueError("Expected a base64 encoded grid string")
+                end = buffer.find(b'"', position + 1)
+                if (end if end >= 0 else len(buffer)) - position - 1 > MAX_JSON_GRID_CHARS:
+                    raise ValueError(f"Grid string longer than {MAX_JSON_GRID_CHARS} characters")
+                if end < 0:
+                    break
+                grid = base64.b64decode(json.loads(buffer[position:end + 1]))
+                if len(grid) < GRID_BYTES:
+                    raise ValueError(f"Expected {GRID_BYTES} bytes of grid data")
+                position = end + 1
+                state = "separator"
+                yield grid[:GRID_BYTES]
+    if state != "end":
+        raise ValueError("JSON array of grids ended early")
+
+
+def format_bulk_lines(start, outputs, top_k_classes) -> str:
+    """ One NDJSON line per row of logits, numbered from start"""
+    with STAGE_SECONDS.time(stage="postprocess"):
+        classes, probabilities = top_k(outputs, max(top_k_classes, 1))
+
+    with STAGE_SECONDS.time(stage="format"):
+        lines = []
+        for offset, (row_classes, row_probabilities) in enumerate(zip(classes, probabilities)):
+            line = {"Index": start + offset, "Class": int(row_classes[0]),
+                    "Label": CLASS_LABELS[row_classes[0]],
+                    "Probability": float(row_probabilities[0])}
+            if top_k_classes:
+                line["Predictions"] = [
+                    {"Class": int(class_num), "Label": CLASS_LABELS[class_num],
+                     "Probability": float(probability)}
+                    for class_num, probability in zip(row_classes, row_probabilities)
+                ]
+            lines.append(json.dumps(line))
+        return "\n".join(lines) + "\n"
+
+
+class BulkResponse(StreamingResponse):
+    """NDJSON stream written while the endpoint is still reading the request body.
+
+    StreamingResponse consumes receive() to watch for the client going away,
+    which would swallow the body chunks; here the body stream itself raises
+    ClientDisconnect instead.
+    """
+
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+@app.post("/prediction/bulk")
+async def read_bulk_prediction(request: Request,
+                               top_k_classes: int = Query(0, alias="top_k", ge=0)):
+    """ Offline scoring of many grids, streamed back as NDJSON while they are scored.
+
+    The body is either a streamed application/octet-stream of concatenated
+    512-byte grids, or a JSON array of base64 grids, both parsed as they
+    arrive. Grids skip the cache and the micro-batcher: they are read into
+    full MAX_BATCH_SIZE batches and run straight through the active model,
+    with the next batch read while the previous one is inferred, so memory
+    stays bounded by two batches however large the upload is. Each line holds the grid's "Index",
+    "Class", "Label" and "Probability", plus "Predictions" with top_k. A
+    failure after the response started is reported as a final "Error" line.
+    """
+    if not serving_ready.is_set():
+        raise HTTPException(status_code=503, detail="Model is not loaded yet")
+    # Held for the whole upload, a model swap drains it instead of retiring the version under it
+    version = model_registry.hold_active()
+
+    if request.headers.get("content-type", "").startswith("application/json"):
+        chunks = json_grid_chunks(request.stream())
+    else:
+        chunks = request.stream()
+
+    async def score():
+        scored = 0
+        pending = None
+        try:
+            failure = None
+            try:
+                async for grids in read_grid_batches(chunks, MAX_BATCH_SIZE):
+                    inference = asyncio.ensure_future(
+                        asyncio.to_thread(version.predict_batch, grids))
+                    if pending is not None:
+                        outputs = await pending
+                        yield format_bulk_lines(scored, outputs, top_k_classes)
+                        scored += len(outputs)
+                    pending = inference
+            except ValueError as error:
+                # Malformed input, still send back what was read before it
+                failure = str(error)
+
+            if pending is not None:
+                outputs = await pending
+                pending = None
+                yield format_bulk_lines(scored, outputs, top_k_classes)
+                scored += len(outputs)
+            if failure is not None:
+                yield json.dumps({"Error": failure, "Index": scored}) + "\n"
+        except ClientDisconnect:
+            return
+        # pylint: disable-next=broad-except
+        except Exception:
+            traceback.print_exc()
+            yield json.dumps({"Error": "Prediction failed", "Index": scored}) + "\n"
+        finally:
+            if pending is not None:
+                pending.cancel()
+            version.release()
+            BULK_GRIDS.inc(scored)
+
+    return BulkResponse(score())
+
+
+@app.websocket("/ws/prediction")
+async def stream_predictions(websocket: WebSocket,
+                             top_k_classes: int = Query(0, alias="top_k", ge=0),
+                             min_probability: float = 0.):
+    """ One connection per drawing session, see grids.apply_grid_update for the updates.
+
+    Bursts of updates are coalesced: while a frame is being inferred, newer
+    updates only replace the pending frame, so only the newest one is inferred
+    next. Every prediction is pushed as the read_prediction JSON plus "Frame",
+    the number of updates received when the inferred frame was taken.
+    """
+    await websocket.accept()
+    frame = np.zeros(GRID_BYTES, dtype=np.uint8)
+    frame_updated = asyncio.Event()
+    received = 0
+
+    async def predict_latest_frame():
+        while True:
+            await frame_updated.wait()
+            frame_updated.clear()
+            frame_num = received
+            try:
+                output_array, = await predict_grids([frame.tobytes()])
+                response = format_prediction(
+                    output_array, top_k_classes, min_probability)
+            except HTTPException as error:
+                response = {"Error": error.detail}
+            # pylint: disable-next=broad-except
+            except Exception:
+                traceback.print_exc()
+                response = {"Response": response_phrase(-1)}
+            response["Frame"] = frame_num
+            await websocket.send_json(response)
+
+    prediction_task = asyncio.create_task(predict_latest_frame())
+    try:
+        while True:
+            message = await websocket.receive_bytes()
+            try:
+                apply_grid_update(frame, message)
+            except ValueError as error:
+                await websocket.send_json({"Error": str(error)})
+                continue
+            received += 1
+            WEBSOCKET_FRAMES.inc()
+            frame_updated.set()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        prediction_task.cancel()
+
+
+@app.get("/stats")
+def read_stats():
+    """ Request coalescing, cache and model version statistics"""
+    return {"batching": batcher_stats(), "cache": prediction_cache.stats(),
+            "models": model_registry.describe()}
+
+
+def require_model_admin():
+    """ Model management endpoints are off unless MLDRAW_MODEL_ADMIN=1"""
+    if not MODEL_ADMIN:
+        raise HTTPException(status_code=403, detail="Model management is disabled")
+
+
+def model_file(version: str) -> str:
+    """ Path of a checkpoint in MODEL_DIR, refusing anything outside it"""
+    path = os.path.join(MODEL_DIR, version)
+    if os.path.basename(version) != version or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"No model {version!r} in {MODEL_DIR}")
+    return path
+
+
+@app.get("/models")
+def read_models():
+    """ Active, candidate and loading versions, and the checkpoints available to load"""
+    available = sorted(os.listdir(MODEL_DIR)) if os.path.isdir(MODEL_DIR) else []
+    return dict(model_registry.describe(), available=available)
+
+
+@app.post("/models/{version}/activate", status_code=202)
+def activate_model(version: str):
+    """ Load, warm and then atomically swap in a checkpoint, draining the old version"""
+    require_model_admin()
+    path = model_file(version)
+    model_registry.load_in_background(
+        version, lambda: build_version(version, path), activate_version)
+    return {"Loading": version}
+
+
+@app.post("/models/{version}/candidate", status_code=202)
+def load_candidate_model(version: str, mode: str = CANARY,
+                         percent: float = Query(5., ge=0., le=100.)):
+    """ Load a checkpoint as a canary (percent of traffic) or shadow (mirrored traffic) candidate"""
+    require_model_admin()
+    if mode not in (CANARY, SHADOW):
+        raise HTTPException(status_code=422, detail=f"mode must be {CANARY!r} or {SHADOW!r}")
+    path = model_file(version)
+    model_registry.load_in_background(
+        version, lambda: build_version(version, path),
+        lambda loaded: model_registry.set_candidate(loaded, mode, percent))
+    return {"Loading": version}
+
+
+@app.post("/models/candidate/promote")
+def promote_candidate_model():
+    """ Make the candidate the active version"""
+    require_model_admin()
+    try:
+        candidate = model_registry.candidate
+        if candidate is None:
+            raise ValueError("There is no candidate version to promote")
+        activate_version(candidate)
+    except ValueError as error:
+        raise HTTPException(status_code=409, detail=str(error)) from error
+    return {"Active": candidate.name}
 
-    if input_num in proper_nouns_list:
-        return {"Response": "I think you are drawing the " + response_string[0].upper() + response_string[1:]}
 
-    if is_vowel(response_string[0]):
+@app.delete("/models/candidate")
+def drop_candidate_model():
+    """ Stop routing to the candidate and drain it"""
+    require_model_admin()
+    model_registry.drop_candidate()
+    return {"Candidate": None}
 
-        return {"Response": "I think you are drawing an " + response_string}
 
-    return {"Response": "I think you are drawing a " + response_string}
+@app.get("/metrics")
+def read_metrics():
+    """ Prometheus text exposition of the server metrics"""
+    return Response(content=render(), media_type=CONTENT_TYPE)
 
 
 @app.get("/input/{byte_data}")
@@ -287,10 +963,14 @@ def read_bytes(byte_data: str):
     # return Items(items=dict(enumerate(convert_bytes_to_uint8_array(byte_data).sum(axis=1))))
 
     bool_array = convert_bytes_to_uint8_array(byte_data)
-    flattened_str = np.array2string(bool_array)
+    flattened_str = np.array2string(
+        bool_array, threshold=sys.maxsize, max_line_width=250)
 
     return {"Data": flattened_str}
 
 
+STARTUP_SECONDS["import"] = time.perf_counter() - PROCESS_STARTED
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     uvicorn.run(app, host="0.0.0.0", port=4000)
@@ -0,0 +1,291 @@
+"""Multi-process inference for the ML-Draw prediction server
+
+The HTTP front end never loads the model. It writes packed grids into
+shared-memory slots and N worker processes decode them, run their own
+backend and write logits back into the matching output slot. With the TFLite
+backend every worker's interpreter maps the same flatbuffer file, so the
+read-only weights live once in the page cache instead of once per process.
+
+A supervisor thread checks the workers every WATCH_INTERVAL seconds. The
+request held by a worker that died fails, and the worker is forked again from
+the server process; a worker that cannot be restarted marks the pool unhealthy.
+"""
+
+import atexit
+import concurrent.futures
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from grids import GRID_BYTES, allocate_batch, unpack_grids
+from inference import load_backend
+
+OUTPUT_DTYPE = np.float32
+# Seconds between liveness checks of the worker processes
+WATCH_INTERVAL = 1.
+# Longest the workers may take to load and warm the model
+STARTUP_TIMEOUT = 300.
+
+L = logging.getLogger(__name__)
+
+
+def _slot_views(input_memory, output_memory, num_slots, max_batch_size, num_classes):
+    """ [slot, grid, byte] packed input and [slot, grid, class] output arrays over shared memory"""
+    inputs = np.ndarray((num_slots, max_batch_size, GRID_BYTES),
+                        dtype=np.uint8, buffer=input_memory.buf)
+    outputs = np.ndarray((num_slots, max_batch_size, num_classes),
+                         dtype=OUTPUT_DTYPE, buffer=output_memory.buf)
+    return inputs, outputs
+
+
+# pylint: disable-next=too-many-arguments
+def _worker_main(worker_id, generation, input_name, output_name, num_slots, max_batch_size, num_classes,
+                 backend_name, model_path, backend_options, requests, results):
+    """ Worker process: serve (slot, count) requests until a None arrives"""
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    inputs, outputs = _slot_views(
+        input_memory, output_memory, num_slots, max_batch_size, num_classes)
+
+    try:
+        model = load_backend(backend_name, model_path, **backend_options)
+        model.warmup()
+    # pylint: disable-next=broad-except
+    except Exception:
+        results.put(("failed", worker_id, generation, traceback.format_exc()))
+        return
+    results.put(("ready", worker_id, generation, None))
+
+    batch = allocate_batch(max_batch_size)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        slot, count = request
+        try:
+            outputs[slot, :count] = model.predict(
+                unpack_grids(inputs[slot, :count], batch))
+            results.put(("done", worker_id, generation, None))
+        # pylint: disable-next=broad-except
+        except Exception:
+            results.put(("error", worker_id, generation, traceback.format_exc()))
+
+    del inputs, outputs
+    input_memory.close()
+    output_memory.close()
+
+
+# pylint: disable-next=too-many-instance-attributes
+class WorkerPool:
+    """Supervisor of N inference worker processes fed through shared-memory slots.
+
+    The slots form a ring of preallocated batch buffers: a caller takes a free
+    slot, writes up to max_batch_size packed grids into it, hands the slot
+    number to an idle worker and gets the slot back once the logits are copied
+    out. `predict` is safe to call from several threads at once.
+
+    Every worker has its own request queue, so the pool knows which request a
+    worker holds when it dies. A restarted worker gets a new generation number
+    and messages of the process it replaced are ignored.
+    """
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, num_workers, backend_name, model_path=None, max_batch_size=32,
+                 num_classes=121, num_slots=None, timeout=30., **backend_options):
+        # Workers must not re-import the server module, which spawn would do
+        self._context = multiprocessing.get_context("fork")
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.restarts = 0
+        num_slots = num_slots or 2 * num_workers
+
+        self._input_memory = shared_memory.SharedMemory(
+            create=True, size=num_slots * max_batch_size * GRID_BYTES)
+        self._output_memory = shared_memory.SharedMemory(
+            create=True, size=num_slots * max_batch_size * num_classes * np.dtype(OUTPUT_DTYPE).itemsize)
+        self._inputs, self._outputs = _slot_views(
+            self._input_memory, self._output_memory, num_slots, max_batch_size, num_classes)
+        self._worker_args = (self._input_memory.name, self._output_memory.name, num_slots,
+                             max_batch_size, num_classes, backend_name, model_path, backend_options)
+
+        self._free_slots = queue.Queue()
+        for slot in range(num_slots):
+            self._free_slots.put(slot)
+        # (worker_id, generation) of workers waiting for a request
+        self._idle = queue.Queue()
+        # Future of the request each busy worker holds
+        self._busy = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._results = self._context.Queue()
+
+        self._generations = [0] * num_workers
+        self._requests = [None] * num_workers
+        self._processes = [None] * num_workers
+        for worker_id in range(num_workers):
+            self._start_worker(worker_id)
+        atexit.register(self.close)
+        self._wait_until_ready()
+
+        self._collector = threading.Thread(
+            target=self._collect_results, name="worker-pool-results", daemon=True)
+        self._collector.start()
+        self._supervisor = threading.Thread(
+            target=self._watch_workers, name="worker-pool-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def _start_worker(self, worker_id):
+        """ Fork a worker with a fresh request queue, so no request of its predecessor is left in it"""
+        self._generations[worker_id] += 1
+        self._requests[worker_id] = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, name=f"inference-worker-{worker_id}", daemon=True,
+            args=(worker_id, self._generations[worker_id]) + self._worker_args
+            + (self._requests[worker_id], self._results))
+        process.start()
+        self._processes[worker_id] = process
+
+    def _wait_until_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        try:
+            for _ in self._processes:
+                status, worker_id, generation, error = self._next_startup_message(deadline)
+                if status == "failed":
+                    raise RuntimeError(
+                        f"Inference worker {worker_id} failed to start:\n{error}")
+                self._idle.put((worker_id, generation))
+        except RuntimeError:
+            self.close()
+            raise
+
+    def _next_startup_message(self, deadline):
+        """ Next ready or failed message, raising if a worker died first or the deadline passed"""
+        while True:
+            try:
+                return self._results.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                for process in self._processes:
+                    if not process.is_alive():
+                        raise RuntimeError(f"Inference worker {process.name} exited with code "
+                                           f"{process.exitcode} before it was ready") from None
+                if time.monotonic() > deadline:
+                    raise RuntimeError(
+                        f"Inference workers not ready after {STARTUP_TIMEOUT:g}s") from None
+
+    def _collect_results(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            status, worker_id, generation, error = message
+            with self._lock:
+                if generation != self._generations[worker_id]:
+                    continue
+                if status == "failed":
+                    self._failed[worker_id] = error
+                    L.error("Inference worker %d failed to restart:\n%s", worker_id, error)
+                    continue
+                future = self._busy.pop(worker_id, None)
+            self._idle.put((worker_id, generation))
+            if future is None:
+                continue
+            if status == "done":
+                future.set_result(None)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def _watch_workers(self):
+        while not self._closed.wait(WATCH_INTERVAL):
+            for worker_id, process in enumerate(self._processes):
+                if not process.is_alive() and worker_id not in self._failed:
+                    self._restart_worker(worker_id, process.exitcode)
+
+    def _restart_worker(self, worker_id, exitcode):
+        """ Fail the request a dead worker held and fork its replacement"""
+        with self._lock:
+            if self._closed.is_set():
+                return
+            future = self._busy.pop(worker_id, None)
+            self.restarts += 1
+            self._start_worker(worker_id)
+        L.warning("Inference worker %d exited with code %s, restarted it", worker_id, exitcode)
+        if future is not None:
+            future.set_exception(RuntimeError(
+                f"Inference worker {worker_id} exited with code {exitcode}"))
+
+    @property
+    def healthy(self) -> bool:
+        """ False once a worker could not be restarted or the pool is closed"""
+        return not self._failed and not self._closed.is_set()
+
+    def _dispatch(self, slot, count):
+        """ Hand the slot to an idle worker of the current generation, returns (worker_id, future)"""
+        while True:
+            try:
+                worker_id, generation = self._idle.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                if len(self._failed) == self.num_workers or self._closed.is_set():
+                    raise RuntimeError("No inference worker is running") from None
+                continue
+            with self._lock:
+                # Left in the queue by a worker that died or was restarted since
+                if generation != self._generations[worker_id] or not self._processes[worker_id].is_alive():
+                    continue
+                future = Future()
+                self._busy[worker_id] = future
+                self._requests[worker_id].put((slot, count))
+            return worker_id, future
+
+    def predict(self, grids) -> np.ndarray:
+        """ Logits of up to max_batch_size packed grids, computed by one of the workers"""
+        count = len(grids)
+        slot = self._free_slots.get()
+        try:
+            for i, grid in enumerate(grids):
+                self._inputs[slot, i] = np.frombuffer(grid, dtype=np.uint8)
+            worker_id, future = self._dispatch(slot, count)
+            try:
+                future.result(timeout=self.timeout)
+            except concurrent.futures.TimeoutError:
+                # Stop the stuck worker before its slot is reused, the supervisor restarts it
+                process = self._processes[worker_id]
+                process.kill()
+                process.join()
+                raise
+            return self._outputs[slot, :count].copy()
+        finally:
+            self._free_slots.put(slot)
+
+    def summary(self):
+        """ Log the worker processes"""
+        L.info("%d inference workers: %s", self.num_workers,
+               ", ".join(str(process.pid) for process in self._processes))
+
+    def close(self):
+        """ Stop the workers and free the shared memory"""
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+
+        del self._inputs, self._outputs
+        for memory in (self._input_memory, self._output_memory):
+            memory.close()
+            memory.unlink()
+        self._input_memory = self._output_memory = None